@@ -40,6 +40,7 @@ import provenance_log
 import json
 import os
 import shutil 
+import time
 
 try:
     from pyblake2 import blake2b
@@ -55,9 +56,36 @@ except ImportError:  # pragma: no cover
     sys.exit()
 
 
+# Named pipe outside of the file system that an idle worker can block on.
+# The file system signals it by writing a byte when the anycast set of the
+# worker's actor goes from empty to non-empty. We keep our end open read-write
+# so opening never blocks and writes never fail for lack of a reader.
+class Notifier:
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.mkfifo(self.path, 0644)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+
+    def signal(self):
+        try:
+            os.write(self.fd, "J")
+        except OSError:
+            # A full pipe means the worker has plenty of pending wakeups.
+            pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            os.unlink(self.path)
+
+
 # In-file-system representation of a worker.
 class Worker:
-    def __init__(self, actorname, workerhandle, actor, user, command, pid):
+    def __init__(self, actorname, workerhandle, actor, user, command, pid,
+                 notifier=None):
         self.actor = actor  # Refence to the actor this worker is instance of.
         self.actorname = actorname  # Name of the actor that we are worker for
         self.workerhandle = workerhandle  # Unique handle for this worker
@@ -65,25 +93,29 @@ class Worker:
         self.command = command
         self.pid = pid
         self.currentjob = None  # The job currently being processed by us.
+        self.batchjobs = []  # The jobs handed to us by our last batch accept.
         # When not set to "S", the module selection policy for load balancing.
         self.module_select_policy = "S"
         # The pollicy for selecting the first job from the anycast set.
         self.job_select_policy = "H"
+        # The maximum number of jobs to hand out on a batch accept.
+        self.batch_size = 16
         self.valid = True  # Make sure we don't try to do cleanup twice.
+        self.notifier = notifier  # Optional wakeup pipe for blocking accept.
     def still_running(self):
         if os.path.exists( "/proc/" + str(self.pid)):
             return True
         return False
     # Cleanup all pending state for the worker.
     def teardown(self):
-        # If there is still a job marked as active, we have no other option
-        # than to commit it.
-        if self.currentjob is not None:
-            self.currentjob.commit(worker=self)
-            self.currentjob = None
+        # If there are still jobs marked as active, we have no other option
+        # than to commit them.
+        self.commit_jobs()
         # Unregister the module and make sure we don't do so twice.
         if self.valid:
             self.actor.unregister(handle=self.workerhandle)
+            if self.notifier is not None:
+                self.notifier.close()
             self.valid = False
 
     # RAIIish way to implicitly clean up state.
@@ -94,12 +126,21 @@ class Worker:
     def unregister(self):
         self.teardown()
 
+    # Commit the jobs from our last accept that weren't explicitly forwarded
+    # or committed.
+    def commit_jobs(self):
+        if self.currentjob is not None:
+            self.currentjob.commit(worker=self)
+            self.currentjob = None
+        for job in self.batchjobs:
+            job.commit(worker=self)
+        self.batchjobs = []
+
     # Accept the next job according to the current job selection pollicy.
     def accept_job(self):
         # If for any reason we forgat to explicitly forward or commit the
         # previous job, we have no other option than comitting it now.
-        if self.currentjob is not None:
-            self.currentjob.commit(worker=self)
+        self.commit_jobs()
         # The "K" job select policy doesn't actually select a job from the
         # anycast set but creates one out of thin air as way to kickstart
         # new data.
@@ -118,6 +159,25 @@ class Worker:
             return self.currentjob.jobhandle
         return None
 
+    # Accept up to count jobs at once according to the current job selection
+    # pollicy. Like with accept_job, jobs from the previous accept that
+    # weren't forwarded or committed get committed.
+    def accept_jobs(self, count):
+        self.commit_jobs()
+        if self.job_select_policy == "K":
+            # Kickstart jobs come one at a time.
+            self.batchjobs = [self.actor.get_kickjob(worker=self)]
+        else:
+            self.batchjobs = self.actor.anycast_pop_n(
+              count=count,
+              module_select_policy=self.module_select_policy,
+              job_select_policy=self.job_select_policy,
+              worker=self)
+        for job in self.batchjobs:
+            job.worker = self
+            job.provenance.accept(actor=self.actorname,command=self.command,user=self.user)
+        return [job.jobhandle for job in self.batchjobs]
+
 
 # A one-per-process object for creating sparse capabilities to be used as
 # handle for workers, jobs or mutables.
@@ -193,7 +253,9 @@ class Job:
         self.actorname = actorname
         # Process the carvpath and flatten or replace with longpath digest if
         # needed.
-        self.carvpath = str(context.parse(carvpath))
+        entity = context.parse(carvpath)
+        self.carvpath = str(entity)
+        self.volume = entity.totalsize  # Size of the job data in bytes.
         self.router_state = router_state
         self.mime_type = mime_type
         self.file_extension = file_extension
@@ -290,6 +352,8 @@ class Job:
         if self.mutable is not None:
             # Retreive the hidden carvpath from the mutable.
             carvpath = self.mutable.carvpath
+            # Make sure all buffered writes to it are in the archive.
+            self.rep.writeback(carvpath=carvpath)
             # Notify opportunistic hashing for this carvpath that the entity
             # is being frozen.
             self.col.freeze(carvpath=carvpath)
@@ -328,6 +392,27 @@ class Job:
                                          file_extension=extension,
                                          provenance=provenance,
                                          worker=self.worker)
+
+    # Submit a batch of children, each as a (carvpath, nexthop, routerstate,
+    # mimetype, extension) tuple. All child carvpaths are pinned on the
+    # refcount stack in one go first, so creating the jobs only bumps entity
+    # refcounts, and the journal records for the batch go out in one write.
+    def submit_children(self, children):
+        carvpaths = []
+        for child in children:
+            carvpath = child[0].split("carvpath/")[-1].split(".")[0]
+            carvpaths.append(str(self.stack.context.parse(carvpath)))
+        self.stack.add_carvpaths(carvpaths)
+        self.journal.start_group()
+        try:
+            for child in children:
+                self.submit_child(carvpath=child[0], nexthop=child[1],
+                                  routerstate=child[2], mimetype=child[3],
+                                  extension=child[4])
+        finally:
+            self.journal.commit_group()
+            for carvpath in carvpaths:
+                self.stack.remove_carvpath(carvpath=carvpath)
     def restorepoint(self):
         self.provenance.restorepoint()
         
@@ -348,6 +433,9 @@ class Actor:
         self.col = col
         self.workers = {}
         self.anycast = {}
+        self.volume = 0  # Running total carvpath volume of the anycast set.
+        # Priority queue with the jobs of the anycast set.
+        self.queue = rep.anycast_queue()
         self.secret = capgen()  # Generate a top-level secret for this actor.
         self.capgen = capgen
         self.weight = 100              # rw extended attribute
@@ -362,10 +450,16 @@ class Actor:
     # Register an instance for this Actor
     def register_worker(self, user, command, pid):   # read-only extended attribute.
         rval = self.capgen(parentcap=self.secret)  # Generate worker sparsecap
+        # The wakeup pipe gets a name derived from the worker sparsecap so
+        # it can't be guessed from the notify directory.
+        notifier = None
+        if self.actors.notify_dir is not None:
+            notifier = Notifier(self.actors.notify_dir + "/" +
+                                self.capgen(parentcap=rval))
         # Make a new worker and register in the workers map.
         self.workers[rval] = Worker(actorname=self.name, workerhandle=rval,
                                     actor=self, user=user, command=command,
-                                    pid=pid)
+                                    pid=pid, notifier=notifier)
         # Also make the new worker part of a all-actors level lookup map.
         self.allworkers[rval] = self.workers[rval]
         return rval  # Return the sparse-cap.
@@ -393,11 +487,13 @@ class Actor:
 
     # Get the per-actor throttle info.
     def throttle_info(self):    # read-only extended attribute
-        set_size = len(self.anycast)
-        # Fetch the total volume of all entries in the set by asking the
-        # repository.
-        set_volume = self.rep.anycast_set_volume(self.anycast)
-        return (set_size, set_volume)
+        return (len(self.anycast), self.volume)
+
+    # Wake up the workers that may be blocking on an empty anycast set.
+    def notify(self):
+        for handle in self.workers:
+            if self.workers[handle].notifier is not None:
+                self.workers[handle].notifier.signal()
 
     # Create and add a job to the anycast set for this actor.
     def anycast_add(self, carvpath, router_state, mime_type, file_extension,
@@ -423,6 +519,20 @@ class Actor:
                                       rep=self.rep,
                                       worker=worker,
                                       mt=self.mt)
+        self.queue.add(carvpath=self.anycast[jobhandle].carvpath,
+                       key=jobhandle)
+        # Keep running totals for this anycast set and for all of them.
+        self.volume += self.anycast[jobhandle].volume
+        self.actors.anycast_count += 1
+        self.actors.anycast_volume += self.anycast[jobhandle].volume
+        # Idle workers only block after finding the anycast set empty, so
+        # only the first job after that needs to wake them up. The load
+        # balancer takes jobs from any actor, so it gets woken too.
+        if len(self.anycast) == 1:
+            self.notify()
+            if (self.name != "loadbalance" and
+                    "loadbalance" in self.actors.actors):
+                self.actors.actors["loadbalance"].notify()
         return
     # Get a job to do a kickstart with.
     def get_kickjob(self,worker=None):
@@ -442,15 +552,10 @@ class Actor:
             # For normal workers, get a best job from the repository according
             # to the select policy.
             best = self.rep.anycast_best(anycast=self.anycast,
-                                         sort_policy=job_select_policy)
+                                         sort_policy=job_select_policy,
+                                         queue=self.queue)
             if best is not None and best in self.anycast:
-                # Pop the job from our set.
-                job = self.anycast.pop(best)
-                # Place it in the accessible jobs map.
-                self.jobs[best] = job
-                # Return the Job
-                job.worker = worker
-                return job
+                return self._pop(best, worker)
         else:
             # For our special "loadbalance" worker, select a module first.
             bestmodule = self.actors.selectactor(module_select_policy)
@@ -460,26 +565,187 @@ class Actor:
                 return best
         return None
 
+    # Pop up to count jobs from the anycast set, picked with a single ranking
+    # of the set for the given job select policy.
+    def anycast_pop_n(self, count, job_select_policy, module_select_policy="S",
+                      worker=None):
+        if self.name != "loadbalance":
+            rval = []
+            for best in self.rep.anycast_best_n(anycast=self.anycast,
+                                                sort_policy=job_select_policy,
+                                                count=count,
+                                                queue=self.queue):
+                if best in self.anycast:
+                    rval.append(self._pop(best, worker))
+            return rval
+        else:
+            # The load balancer takes its whole batch from one module.
+            bestmodule = self.actors.selectactor(module_select_policy)
+            if bestmodule is not None:
+                return self.actors[bestmodule].anycast_pop_n(
+                         count, job_select_policy, worker=worker)
+        return []
+
+    # Move a job from the anycast set to the accessible jobs map.
+    def _pop(self, key, worker):
+        job = self.anycast.pop(key)
+        self.queue.remove(key=key)
+        self.volume -= job.volume
+        self.actors.anycast_count -= 1
+        self.actors.anycast_volume -= job.volume
+        self.jobs[key] = job
+        job.worker = worker
+        return job
+
+# Buffered writer for the journal and the provenance log. Every record is a
+# JSON line carrying a sequence number. Records are collected in memory and
+# written out with a single write per batch once buffer_size bytes are
+# pending or the oldest pending record is interval seconds old. Records that
+# are still pending when we crash are lost, the durability policy decides
+# what happens to the ones that were written:
+#   none   : Handed to the OS, no fdatasync.
+#   group  : Each batch written is followed by a single fdatasync. Batches
+#            written from step() leave the fdatasync to sync(), so it can be
+#            done without holding the file system lock.
+#   strict : Every record (or group of records) is written and synced at once.
+# On open, a torn tail left behind by a crash, a partial last line or a
+# record breaking the sequence, gets truncated.
 class JournalFile:
-    def __init__(self,jfname):
+    def __init__(self, jfname, buffer_size=0, interval=1.0, policy="none"):
+        if policy not in ("none", "group", "strict"):
+            raise RuntimeError("Invalid journal durability policy " + policy)
         self.active_file_name = jfname
         self.previous_file_name = jfname + "-previous"
-        self.active_file = open(self.active_file_name, "a", 0)  # Unbuffered journal log.
-    def write(self,data):
-        self.active_file.write(data)
+        self.buffer_size = buffer_size
+        self.interval = interval
+        self.policy = policy
+        self.pending = []  # Serialized records not yet written.
+        self.pending_size = 0
+        self.oldest = None  # Time the oldest pending record was added.
+        self.group = False  # Hold back writes for a batch of records.
+        self.unsynced = False  # Records written but not yet synced.
+        self.seq = self._recover()
+        self.fd = self._open()
+
+    def _open(self):
+        return os.open(self.active_file_name,
+                       os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+
+    # Truncate a torn tail and return the next sequence number to use.
+    def _recover(self):
+        seq = None
+        if not os.path.exists(self.active_file_name):
+            return 0
+        good = 0
+        with open(self.active_file_name, "r") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break
+                # Records from before sequence numbers were introduced
+                # don't have one.
+                if "seq" in rec:
+                    if seq is not None and rec["seq"] != seq:
+                        break
+                    seq = rec["seq"] + 1
+                good += len(line)
+        size = os.path.getsize(self.active_file_name)
+        if good < size:
+            # FIXME, we need better logging.
+            print "WARNING: Truncating torn tail of " + \
+                self.active_file_name + ":", size - good, "bytes"
+            with open(self.active_file_name, "r+") as f:
+                f.truncate(good)
+        if seq is None:
+            return 0
+        return seq
+
+    # Add a record, flushing if a threshold was reached.
+    def append(self, rec):
+        rec["seq"] = self.seq
+        self.seq += 1
+        line = json.dumps(rec, sort_keys=True) + "\n"
+        self.pending.append(line)
+        self.pending_size += len(line)
+        if self.oldest is None:
+            self.oldest = time.time()
+        if not self.group:
+            self._check()
+
+    def _check(self, sync=True):
+        if (self.policy == "strict" or
+           self.pending_size >= self.buffer_size or
+           time.time() - self.oldest >= self.interval):
+            self.flush(sync=sync)
+
+    # Write out all pending records as one batch. With sync False, the
+    # fdatasync is left to step() and sync().
+    def flush(self, sync=True):
+        if len(self.pending) > 0:
+            data = "".join(self.pending)
+            self.pending = []
+            self.pending_size = 0
+            self.oldest = None
+            while len(data) > 0:
+                data = data[os.write(self.fd, data):]
+            if self.policy != "none":
+                self.unsynced = True
+        if sync and self.unsynced:
+            self.unsynced = False
+            os.fdatasync(self.fd)
+
+    # Periodic flush of records that have been pending too long. Returns a
+    # duplicate of our file descriptor to hand to sync() if written records
+    # still need an fdatasync, or else None.
+    def step(self):
+        if self.oldest is not None and not self.group:
+            self._check(sync=False)
+        if not self.unsynced:
+            return None
+        self.unsynced = False
+        return os.dup(self.fd)
+
+    # Sync and close a file descriptor returned by step().
+    def sync(self, fd):
+        if fd is not None:
+            try:
+                os.fdatasync(fd)
+            finally:
+                os.close(fd)
+
+    # Hold back records until commit_group so a batch of them goes to the
+    # journal with a single write.
+    def start_group(self):
+        self.group = True
+
+    def commit_group(self):
+        self.group = False
+        if self.oldest is not None:
+            self._check()
+
     def newfile(self):
+        self.flush()
         if os.path.exists(self.previous_file_name):
             os.unlink(self.previous_file_name)
-        self.active_file.close()
+        os.close(self.fd)
         shutil.move(self.active_file_name,self.previous_file_name)
-        self.active_file = open(self.active_file_name, "a", 0) # Unbuffered journal log. 
+        self.fd = self._open()
+
     def close(self):
-        self.active_file.close()
+        self.flush()
+        os.close(self.fd)
 
 # State shared between different actors and a central coordination point.
 class Actors:
-    def __init__(self, rep, journal, provenance, context, stack, col, mt = None):
+    def __init__(self, rep, journal, provenance, context, stack, col, mt = None,
+                 notify_dir=None, journal_buffer=0, journal_interval=1.0,
+                 journal_durability="none"):
         self.rep = rep
+        # Directory for worker wakeup pipes, None for polling only.
+        self.notify_dir = notify_dir
         self.context = context
         self.stack = stack
         self.col = col
@@ -489,8 +755,18 @@ class Actors:
         self.jobs = {}
         self.newdata = {}
         self.capgen = CapabilityGenerator()  # Create capability generator.
-        # Unbuffered provenance log.
-        self.provenance_log = open(provenance, "a", 0)
+        # Running totals of job count and volume over all anycast sets.
+        self.anycast_count = 0
+        self.anycast_volume = 0
+        # Provenance log and journal, opening them truncates any torn tail.
+        self.provenance_log = JournalFile(provenance,
+                                          buffer_size=journal_buffer,
+                                          interval=journal_interval,
+                                          policy=journal_durability)
+        self.journal = JournalFile(journal,
+                                   buffer_size=journal_buffer,
+                                   interval=journal_interval,
+                                   policy=journal_durability)
         # Restoring old state from journal;
         journalinfo = {}
         if os.path.exists(journal):
@@ -515,7 +791,6 @@ class Actors:
                                 if dtype == "RPENT":
                                     dkey = dat["key"]
                                     journalinfo[dkey] = dat["provenance"]
-        self.journal = JournalFile(journal)
         self.ticks = 0
         if len(journalinfo) > 0:
             for needrestore in journalinfo:
@@ -523,11 +798,16 @@ class Actors:
                 self.journal_restore(provenance_log,needrestore)
     def restorepoint(self):
         self.journal.newfile()
-        self.journal.write("{\"type\" : \"RESTOREPOINT\", \"jobcount\" : " + str(len(self.jobs)) + " }\n")
+        self.journal.append({"type": "RESTOREPOINT",
+                             "jobcount": len(self.jobs)})
         for jobkey in self.jobs:
             self.jobs[jobkey].restorepoint()
         for actorname in self.actors:
             self.actors[actorname].restorepoint()
+    # Get the throttle info for all anycast sets together.
+    def throttle_info(self):
+        return (self.anycast_count, self.anycast_volume)
+
     def tick(self):
         self.ticks = self.ticks + 1
         if self.ticks == 4096:
@@ -643,4 +923,112 @@ class Actors:
         return False
 
 if __name__ == '__main__':  # pragma: no cover
-    print "We should probably write some test code here"
+    import carvpath
+    import merkletree
+    import repository
+    import tempfile
+    import shutil
+    # Check the running anycast set volumes against recomputed ones, with
+    # both single and batched pops.
+    tmpdir = tempfile.mkdtemp()
+    try:
+        context = carvpath.Context({}, 160)
+        mtlog = merkletree.MerkleTreeLog(tmpdir + "/mt.log")
+        rep = repository.Repository(reppath=tmpdir + "/archive.dd",
+                                    context=context,
+                                    ohash_log=tmpdir + "/oh.log",
+                                    refcount_log=tmpdir + "/rc.log",
+                                    mtlog=mtlog)
+        rep.newmutable(chunksize=1000000)
+        actors = Actors(rep=rep,
+                        journal=tmpdir + "/journal.log",
+                        provenance=tmpdir + "/provenance.log",
+                        context=context,
+                        stack=rep.stack,
+                        col=rep.col,
+                        mt=mtlog)
+        random.seed(42)
+        names = ["foo", "bar", "baz"]
+        for step in range(0, 2000):
+            actor = actors[random.choice(names)]
+            if random.random() < 0.6:
+                fragments = []
+                offset = random.randint(0, 900000)
+                for index in range(0, random.randint(1, 4)):
+                    if random.random() < 0.2:
+                        fragments.append("S" + str(random.randint(1, 5000)))
+                    else:
+                        size = random.randint(1, 9000)
+                        fragments.append(str(offset) + "+" + str(size))
+                        offset += size + random.randint(1, 9000)
+                actor.anycast_add(carvpath="_".join(fragments),
+                                  router_state="",
+                                  mime_type="application/octet-stream",
+                                  file_extension="dat",
+                                  provenance=None)
+            else:
+                if random.random() < 0.7:
+                    job = actor.anycast_pop(random.choice("SRDWHOdr"))
+                    if job is not None:
+                        job.commit()
+                else:
+                    for job in actor.anycast_pop_n(
+                                 count=random.randint(1, 8),
+                                 job_select_policy=random.choice("SRDWHOdr")):
+                        job.commit()
+            total = 0
+            for name in names:
+                # Recompute the set volume from the job carvpaths.
+                volume = 0
+                for job in actors[name].anycast.values():
+                    volume += context.parse(path=job.carvpath).totalsize
+                assert actors[name].throttle_info() == (
+                         len(actors[name].anycast), volume)
+                total += volume
+            assert actors.throttle_info() == (len(actors["foo"].anycast) +
+                                              len(actors["bar"].anycast) +
+                                              len(actors["baz"].anycast),
+                                              total)
+        print "Anycast set volumes OK:", actors.throttle_info()
+        # A torn journal tail should get truncated on open and the sequence
+        # numbers should carry on where the intact records left off.
+        jname = tmpdir + "/torn.log"
+        journal = JournalFile(jname, buffer_size=4096, policy="group")
+        for index in range(0, 100):
+            journal.append({"type": "TEST", "index": index})
+        journal.close()
+        with open(jname, "a") as f:
+            f.write("{\"type\": \"TEST\", \"seq\": 100, \"ind")
+        journal = JournalFile(jname)
+        assert journal.seq == 100
+        journal.append({"type": "TEST", "index": 100})
+        journal.close()
+        with open(jname, "a") as f:
+            f.write("{\"type\": \"TEST\", \"seq\": 7}\n")
+        journal = JournalFile(jname)
+        journal.close()
+        with open(jname) as f:
+            records = [json.loads(line) for line in f]
+        assert [rec["seq"] for rec in records] == range(0, 101)
+        print "Journal torn tail recovery OK:", len(records)
+        # Records written from step() get synced later on, through a file
+        # descriptor that outlives a switch to a new journal file.
+        journal = JournalFile(jname, buffer_size=4096, interval=0.05,
+                              policy="group")
+        journal.start_group()
+        journal.append({"type": "TEST", "index": 101})
+        time.sleep(0.1)
+        assert journal.step() is None
+        journal.commit_group()
+        journal.append({"type": "TEST", "index": 102})
+        time.sleep(0.1)
+        fd = journal.step()
+        assert fd is not None and journal.step() is None
+        journal.newfile()
+        journal.sync(fd=fd)
+        journal.close()
+        with open(jname + "-previous") as f:
+            assert len(f.readlines()) == 103
+        print "Journal deferred sync OK"
+    finally:
+        shutil.rmtree(tmpdir)
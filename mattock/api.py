@@ -36,13 +36,15 @@ import os
 import os.path
 import re
 import json
+import errno
+import select
 from time import sleep
 import carvpath
 
 
 # Object representing a file under $MP/carvpath/
 class _CarvPathFile:
-    def __init__(self, mp, cp, context):
+    def __init__(self, mp, cp, context, verify=True, size=None, ohash=None):
         self.mp = mp
         dotpos = cp.rfind(".")
         if dotpos == -1:
@@ -52,8 +54,12 @@ class _CarvPathFile:
             self.dir_carvpath = cp.split(".")[0]
             self.file_carvpath = cp
         self.context = context
+        # Size and completed opportunistic hash if already known, for example
+        # from a job descriptor.
+        self.size = size
+        self.ohash = ohash
         filpath = mp + "/" + self.file_carvpath
-        if not os.path.isfile(filpath):
+        if verify and not os.path.isfile(filpath):
             raise IndexError("Invalid CarvPath " + cp)
         self.xa = xattr.xattr(filpath)
 
@@ -85,6 +91,9 @@ class _CarvPathFile:
 
     # Retreiver opportunistic hash exteded attibute.
     def opportunistic_hash(self):
+        # A completed hash won't change anymore.
+        if self.ohash is not None:
+            return self.ohash
         st = self.xa["user.opportunistic_hash"].split(";")
         return {"hash": st[0],
                 "hash_offset": int(st[1])}
@@ -99,6 +108,8 @@ class _CarvPathFile:
 
     # Retreive the size of the entity.
     def file_size(self):
+        if self.size is not None:
+            return self.size
         return self.as_entity().totalsize
 
 
@@ -108,15 +119,25 @@ class _Job:
         self.isdone = False  # Keep from doing same cleanup twice.
         self.mp = mp
         self.ctl = xattr.xattr(job_ctl)
-        # Proactively fetch routing state from previous actor.
-        rstate = self.ctl["user.routing_info"].split(";")
-        self.router_state = rstate[1]
-        self.jobactor = rstate[0]
-        # Proactively retreive job carvpath and create a CarvPathFile object.
+        # Proactively fetch routing state, mime type, carvpath and hashing
+        # state for the job in a single job descriptor.
+        desc = json.loads(self.ctl["user.job_descriptor"])
+        self.router_state = desc["router_state"].encode("utf-8")
+        self.jobactor = desc["actor"].encode("utf-8")
+        self.mime_type = desc["mime_type"].encode("utf-8")
+        ohash = None
+        if desc["hash_done"]:
+            ohash = {"hash": desc["hash"].encode("utf-8"),
+                     "hash_offset": desc["hash_offset"]}
+        # Create a CarvPathFile object for the job carvpath, MattockFS vouches
+        # for it so there is no need to check it exists.
         self.carvpath = _CarvPathFile(
                            mp=mp,
-                           cp=self.ctl["user.job_carvpath"],
-                           context=context)
+                           cp=desc["carvpath"].encode("utf-8"),
+                           context=context,
+                           verify=False,
+                           size=desc["size"],
+                           ohash=ohash)
         self.newdata = None  # There is no active newdata yet for this job.
 
     # Allocate a repository chunk for storage of derived job child (meta) data
@@ -160,6 +181,27 @@ class _Job:
             self.ctl["user.submit_child"] = val.encode()
             self.newdata = None
 
+    # Submit a list of children at once, each a (carvpath, nextactor,
+    # routerstate, mimetype, extension) tuple as for childsubmit. Children
+    # are sent in as few round trips as the extended attribute size limit
+    # allows.
+    def childsubmit_many(self, children):
+        if self.isdone is False:
+            lines = []
+            size = 0
+            for child in children:
+                line = ";".join(child)
+                if size + len(line) + 1 > 65536 and len(lines) > 0:
+                    self.ctl["user.submit_children"] = (
+                      "\n".join(lines).encode())
+                    lines = []
+                    size = 0
+                lines.append(line)
+                size += len(line) + 1
+            if len(lines) > 0:
+                self.ctl["user.submit_children"] = "\n".join(lines).encode()
+            self.newdata = None
+
     # Mark the job as done without specifying a new target. This should close
     # and flush the provenance log for the toolchain this jib belongs to.
     def done(self):
@@ -194,14 +236,26 @@ class _Context:
                                      ".ctl")
         # Register as worker with MattockFS
         self.worker_ctl = None
+        self.notify_fd = None
         path = self.actor_ctl["user.register_worker"]
         self.worker_ctl = xattr.xattr(self.mountpoint + "/" + path)
+        # Open our wakeup pipe if MattockFS provides one, otherwise we fall
+        # back to polling for jobs.
+        try:
+            fifo = self.worker_ctl["user.notify_fifo"]
+            self.notify_fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+        except:
+            pass
+        self.batch_size = None  # Batch size last set for poll_jobs.
         # Set job select policy if supplied as constructor argument
         if initial_sort_policy is not None:
             self.set_job_select_policy(policy=initial_sort_policy)
 
     # RAIIish unregister for MattockFS registered worker.
     def __del__(self):
+        if self.notify_fd is not None:
+            os.close(self.notify_fd)
+            self.notify_fd = None
         if self.worker_ctl is not None:
             try:
                 self.worker_ctl["user.unregister"] = "1"
@@ -235,12 +289,53 @@ class _Context:
                     job_ctl=self.mountpoint + "/" + job,
                     context=self.context)
 
-    # Get the next job, if non is available, keep polling until one is.
-    def get_job(self):
+    # Fetch up to count jobs at once according to select policy, or an empty
+    # list if non are available. Jobs from a previous batch that weren't
+    # forwarded or marked as done get committed by MattockFS. MattockFS
+    # ignores batch sizes over 512, so count gets clamped to that.
+    def poll_jobs(self, count):
+        count = max(1, min(count, 512))
+        if count != self.batch_size:
+            self.worker_ctl["user.batch_size"] = str(count)
+            self.batch_size = count
+        try:
+            jobs = self.worker_ctl["user.accept_batch"]
+        except:
+            return []
+        return [_Job(mp=self.mountpoint,
+                     job_ctl=self.mountpoint + "/" + job,
+                     context=self.context) for job in jobs.split(";")]
+
+    # Block until MattockFS signals new jobs may be available or until
+    # timeout seconds have passed. Without a wakeup pipe just sleep a bit.
+    def wait_job(self, timeout=1.0):
+        if self.notify_fd is None:
+            sleep(0.05)
+            return
+        ready = select.select([self.notify_fd], [], [], timeout)[0]
+        if len(ready) > 0:
+            # Drain all pending wakeups, we poll for jobs until none are left
+            # anyway.
+            while True:
+                try:
+                    data = os.read(self.notify_fd, 4096)
+                except OSError as err:
+                    if err.errno != errno.EAGAIN:
+                        raise
+                    return
+                if len(data) == 0:
+                    # MattockFS went away, go back to polling.
+                    os.close(self.notify_fd)
+                    self.notify_fd = None
+                    return
+
+    # Get the next job, if non is available, wait for one to become
+    # available.
+    def get_job(self, timeout=1.0):
         while True:
             job = self.poll_job()
             if job is None:
-                sleep(0.05)
+                self.wait_job(timeout=timeout)
             else:
                 yield job
 
@@ -297,6 +392,46 @@ class MountPoint:
         st = self.main_ctl["user.fadvise_status"].split(";")
         return {"normal": int(st[0]), "dontneed": int(st[1])}
 
+    # Request hit/miss statistics for the carvpath parse cache.
+    def parse_cache_status(self):
+        st = self.main_ctl["user.parse_cache_status"].split(";")
+        return {"hits": int(st[0]), "misses": int(st[1]),
+                "entries": int(st[2]), "size": int(st[3])}
+
+    # Request hit/miss statistics for the archive block cache.
+    def block_cache_status(self):
+        st = self.main_ctl["user.block_cache_status"].split(";")
+        return {"hits": int(st[0]), "misses": int(st[1]),
+                "blocks": int(st[2]), "budget": int(st[3])}
+
+    # Request hit/miss and staging statistics for the tier cache of hot data
+    # on fast storage.
+    def tier_cache_status(self):
+        st = self.main_ctl["user.tier_cache_status"].split(";")
+        return {"hits": int(st[0]), "misses": int(st[1]),
+                "blocks": int(st[2]), "queued": int(st[3]),
+                "lag_ms": int(st[4]), "budget": int(st[5])}
+
+    # Request the I/O budget (bytes per second) for background completion of
+    # opportunistic hashes.
+    def hash_budget(self):
+        return int(self.main_ctl["user.hash_budget"])
+
+    # Set the I/O budget for background hash completion, zero disables it.
+    def set_hash_budget(self, budget):
+        self.main_ctl["user.hash_budget"] = str(budget)
+
+    # Request statistics for background hash completion.
+    def hash_completion_status(self):
+        st = self.main_ctl["user.hash_completion_status"].split(";")
+        return {"pending": int(st[0]), "completed": int(st[1]),
+                "bytes_read": int(st[2])}
+
+    # Request basic stats on the status of all anycast sets together.
+    def total_anycast_status(self):
+        st = self.main_ctl["user.anycast_status"].split(";")
+        return {"set_size": int(st[0]), "set_volume": int(st[1])}
+
     # Request a CarvPathFile object  for the archive as a whole.
     def full_archive(self):
         return _CarvPathFile(self.mountpoint,
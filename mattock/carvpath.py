@@ -31,6 +31,9 @@
 import copy
 import os
 import fcntl
+import bisect
+from array import array
+from collections import OrderedDict
 
 
 try:
@@ -46,6 +49,27 @@ except ImportError:  # pragma: no cover
     print("")
     sys.exit()
 
+# Array typecode for 64 bit offsets and sizes. Python 2 arrays don't know
+# about 'q', but 'l' is 64 bits wide on the 64 bit Linux platforms we run on.
+try:
+    array('q')
+    _INT64 = 'q'
+except ValueError:  # pragma: no cover
+    _INT64 = 'l'
+
+# NumPy is optional; without it the sweep line engine used for merging large
+# entities runs in pure Python.
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# Entities with fewer fragments than this (combined) get merged/unmerged by
+# walking both entities in _fragapply. Bigger ones go through the sweep line
+# engine, vectorized with NumPy from _NUMPY_FRAGMENTS fragments on.
+_SWEEP_FRAGMENTS = 32
+_NUMPY_FRAGMENTS = 512
+
 
 # A fragent represents a contiguous section of a higher level data entity.
 class Fragment:
@@ -176,6 +200,81 @@ class Sparse:
         self.size += sz
 
 
+# Compact list-like container for the fragments of an entity. Rather than
+# keeping one Fragment or Sparse object per fragment, offsets, sizes and
+# sparse flags are stored in parallel arrays. Fragment and Sparse objects only
+# get created when a fragment is accessed.
+class _FragmentArray:
+    def __init__(self, offsets=None, sizes=None, sparse=None):
+        if offsets is None:
+            offsets = array(_INT64)
+            sizes = array(_INT64)
+            sparse = array('b')
+        self.offsets = offsets
+        self.sizes = sizes
+        self.sparse = sparse
+
+    def copy(self):
+        return _FragmentArray(offsets=array(_INT64, self.offsets),
+                              sizes=array(_INT64, self.sizes),
+                              sparse=array('b', self.sparse))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    # Create a Fragment or Sparse object for the fragment at index.
+    def __getitem__(self, index):
+        if self.sparse[index]:
+            return Sparse(size=self.sizes[index])
+        return Fragment(offset=self.offsets[index], size=self.sizes[index])
+
+    def __setitem__(self, index, frag):
+        if frag.issparse():
+            self.offsets[index] = 0
+            self.sparse[index] = 1
+        else:
+            self.offsets[index] = frag.offset
+            self.sparse[index] = 0
+        self.sizes[index] = frag.size
+
+    def __iter__(self):
+        for index in range(0, len(self.sizes)):
+            yield self[index]
+
+    # The carvpath tokens for all fragments, without creating fragment
+    # objects.
+    def tokens(self):
+        for index in range(0, len(self.sizes)):
+            if self.sparse[index] or self.sizes[index] == 0:
+                yield "S" + str(self.sizes[index])
+            else:
+                yield str(self.offsets[index]) + "+" + str(self.sizes[index])
+
+    def append(self, frag):
+        if frag.issparse():
+            self.offsets.append(0)
+            self.sparse.append(1)
+        else:
+            self.offsets.append(frag.offset)
+            self.sparse.append(0)
+        self.sizes.append(frag.size)
+
+    # Append a fragment, or if it is directly adjacent to our last fragment
+    # and of the same type, grow the last fragment instead.
+    def add(self, frag):
+        sparse = frag.issparse()
+        if (len(self.sizes) > 0 and
+           bool(self.sparse[-1]) == sparse and
+           (sparse or self.offsets[-1] + self.sizes[-1] == frag.offset)):
+            self.sizes[-1] += frag.size
+        else:
+            self.append(frag)
+
+    # Grow the last fragment in place.
+    def growlast(self, sz):
+        self.sizes[-1] += sz
+
+
 # Helper function for creating either a sparse region or a fragment from a
 # carvpath fragment/sparse token.
 def _asfrag(fragstring):
@@ -201,12 +300,28 @@ class _Entity:
     # An _Entity carvpath consists of one or more Fragment and/or Sparse
     # carvpath tokens seperated by a '_' character.for example:
     #  '0+4096_S8192_4096+4096'
-    def __init__(self, lpmap, maxfstoken, carvpath=None, fragments=None):
+    # A compact entity keeps its fragments in a _FragmentArray instead of a
+    # list of Fragment and Sparse objects.
+    def __init__(self, lpmap, maxfstoken, carvpath=None, fragments=None,
+                 compact=False):
         self.longpathmap = lpmap
         self.maxfstoken = maxfstoken
+        self.compact = compact
         if fragments is None:
             fragments = []
-        self.fragments = []
+        if compact:
+            self.fragments = _FragmentArray()
+        else:
+            self.fragments = []
+        # Lazily built index of fragment start offsets within the entity.
+        self._starts = None
+        # Lazily built index for range of interest lookups.
+        self._roi = None
+        # Memoized canonical carvpath string and hash.
+        self._str = None
+        self._hash = None
+        # The parse cache entity we share our fragments with, if any.
+        self._origin = None
         if carvpath is not None:
             # Any carvpath starting with a capital D must be looked up in our
             # longtoken database
@@ -220,6 +335,14 @@ class _Entity:
         for frag in fragments:
             self.unaryplus(other=frag)
 
+    # Create a new entity with the same longpath map, maximum token length
+    # and storage mode as this one.
+    def _new(self, fragments=None):
+        return _Entity(lpmap=self.longpathmap,
+                       maxfstoken=self.maxfstoken,
+                       fragments=fragments,
+                       compact=self.compact)
+
     # Copy with or without sparse sections.
     def copy(self, stripsparse=False):
         if stripsparse:
@@ -227,14 +350,51 @@ class _Entity:
             for frag in self.fragments:
                 if frag.issparse() == False:
                     fragments.append(frag.copy())
-            return _Entity(lpmap=self.longpathmap,
-                           maxfstoken=self.maxfstoken,
-                           fragments=fragments)
+            return self._new(fragments=fragments)
         else:
-            return _Entity(
-                    lpmap=self.longpathmap,
-                    maxfstoken=self.maxfstoken,
-                    fragments=copy.deepcopy(self.fragments))
+            if self.compact:
+                # No need to go through Fragment objects, just copy the
+                # arrays.
+                rval = self._new()
+                rval.fragments = self.fragments.copy()
+                rval.totalsize = self.totalsize
+            else:
+                rval = self._new(fragments=copy.deepcopy(self.fragments))
+            # An exact copy has the same canonical form.
+            rval._str = self._str
+            rval._hash = self._hash
+            return rval
+
+    # Create a copy-on-write clone that shares our fragments untill it gets
+    # changed. Used for handing out the immutable entities kept in the parse
+    # cache.
+    def _cowclone(self):
+        rval = self._new()
+        rval.fragments = self.fragments
+        rval.totalsize = self.totalsize
+        rval._starts = self._starts
+        rval._str = self._str
+        rval._hash = self._hash
+        rval._origin = self
+        return rval
+
+    # Get our own copy of shared fragments before changing them in place.
+    def _unshare(self):
+        if self._origin is not None:
+            if self.compact:
+                self.fragments = self.fragments.copy()
+            else:
+                self.fragments = copy.deepcopy(self.fragments)
+            self._origin = None
+
+    # Drop the cached index, carvpath string and hash after our fragments
+    # changed.
+    def _invalidate(self):
+        self._starts = None
+        self._roi = None
+        self._str = None
+        self._hash = None
+        self._origin = None
 
     # Use a secure hash function to get a shorter representation of carvpath.
     # Than register the shorter representation  in redis so we can find the
@@ -257,20 +417,40 @@ class _Entity:
     # Grow the entity by extending on its final fragment or, if there are non,
     # by creating a first fragment with offset zero.
     def grow(self, chunksize):
+        self._unshare()
+        self._invalidate()
         if len(self.fragments) == 0:
             self.fragments.append(Fragment(offset=0, size=chunksize))
         else:
-            self.fragments[-1].grow(sz=chunksize)
+            if self.compact:
+                self.fragments.growlast(sz=chunksize)
+            else:
+                # Our last fragment object may be shared with other entities.
+                self.fragments[-1] = copy.copy(self.fragments[-1])
+                self.fragments[-1].grow(sz=chunksize)
         self.totalsize += chunksize
 
-    # Casting to a carvpath string
+    # Casting to a carvpath string. The result is memoized untill the
+    # entity changes, so long carvpaths only get hashed and stored in the
+    # longpath map once.
     def __str__(self):
+        if self._str is None:
+            self._str = self._canonical()
+            if self._origin is not None:
+                # Let the parse cache entity remember it as well.
+                self._origin._str = self._str
+        return self._str
+
+    def _canonical(self):
         # Anything of zero size is represented as zero size sparse region.
         if len(self.fragments) == 0:
             return "S0"
         # Apply a cast to string on each of the fragment and concattenate the
         # result using '_' as join character.
-        rval = "_".join(map(str, self.fragments))
+        if self.compact:
+            rval = "_".join(self.fragments.tokens())
+        else:
+            rval = "_".join(map(str, self.fragments))
         # If needed, store long carvpath in database and replace the long
         # carvpath with its digest.
         if len(rval) > self.maxfstoken:
@@ -279,7 +459,9 @@ class _Entity:
             return rval
 
     def __hash__(self):
-        return hash(str(self))
+        if self._hash is None:
+            self._hash = hash(str(self))
+        return self._hash
 
     # Implementation of < for Entity objects
     def __lt__(self, other):
@@ -359,9 +541,14 @@ class _Entity:
                 self.unaryplus(other=other.fragments[index])
         else:
             # Or a single fragment.
+            self._unshare()
+            self._invalidate()
             # If the new fragment is directly adjacent and of the same type,
             # we don't add it but instead we grow the last existing fragment.
-            if (len(self.fragments) > 0 and
+            if self.compact:
+                # The fragment array grows its last fragment in place.
+                self.fragments.add(frag=other)
+            elif (len(self.fragments) > 0 and
                self.fragments[-1].issparse() == other.issparse() and
                (other.issparse() or
                (self.fragments[-1].getoffset() +
@@ -378,11 +565,42 @@ class _Entity:
     # Appending two entities together, merging the tails if possible.
     def __add__(self, other):
         # Express a+b in terms of operator+=
-        rval = _Entity(lpmap=self.longpathmap, maxfstoken=self.maxfstoken)
+        rval = self._new()
         rval.unaryplus(other=self)
         rval.unaryplus(other=other)
         return rval
 
+    # Get the (cached) cumulative size index: the offset within the entity
+    # where each of the fragments starts.
+    def _startindex(self):
+        if self._starts is None:
+            if self.compact:
+                starts = array(_INT64)
+            else:
+                starts = []
+            start = 0
+            for size in self._sizes():
+                starts.append(start)
+                start += size
+            self._starts = starts
+            if self._origin is not None:
+                self._origin._starts = starts
+        return self._starts
+
+    # Get the index of the fragment holding offset, together with the offset
+    # within the entity where that fragment starts.
+    def fragment_at(self, offset):
+        starts = self._startindex()
+        index = max(bisect.bisect_right(starts, offset) - 1, 0)
+        return (index, starts[index])
+
+    # The sizes of all fragments, without creating fragment objects for
+    # compact entities.
+    def _sizes(self):
+        if self.compact:
+            return self.fragments.sizes
+        return [frag.size for frag in self.fragments]
+
     # Helper generator function for getting the per-fragment chunks for a
     # subentity.
     # The function yields the parent chunks that fit within the offset/size
@@ -397,44 +615,41 @@ class _Entity:
                     size = self.totalsize - offset
             else:
                 raise IndexError('Not within parent range')
-        # We start of at offset 0 of the parent entity whth our initial offset
-        # and size.
-        start = 0
+        if size == 0:
+            return
+        # Bisect our way to the last parent fragment starting at or before
+        # offset, skipping all fragments that fully exist before the
+        # offset/size region we are looking for.
+        starts = self._startindex()
+        index = bisect.bisect_right(starts, offset) - 1
         startoffset = offset
         startsize = size
-        # Process each parent fragment
-        for parentfrag in self.fragments:
-            # Skip the fragments that fully exist before the ofset/size region
-            # we are looking for.
-            if (start + parentfrag.size) > startoffset:
-                # Determine the size of the chunk we need to process
-                maxchunk = parentfrag.size + start - startoffset
-                if maxchunk > startsize:
-                    chunksize = startsize
-                else:
-                    chunksize = maxchunk
-                # Yield the proper type of fragment
-                if chunksize > 0:
-                    if parentfrag.issparse():
-                        yield Sparse(size=chunksize)
-                    else:
-                        yield Fragment(
-                               offset=parentfrag.getoffset()+startoffset-start,
-                               size=chunksize)
-                    # Update startsize for the rest of our data
-                    startsize -= chunksize
-                # Update the startoffset for the rest of our data
-                if startsize > 0:
-                    startoffset += chunksize
+        # Process parent fragments untill we have all of our data.
+        while startsize > 0:
+            parentfrag = self.fragments[index]
+            start = starts[index]
+            # Determine the size of the chunk we need to process
+            maxchunk = parentfrag.size + start - startoffset
+            if maxchunk > startsize:
+                chunksize = startsize
+            else:
+                chunksize = maxchunk
+            # Yield the proper type of fragment
+            if chunksize > 0:
+                if parentfrag.issparse():
+                    yield Sparse(size=chunksize)
                 else:
-                    # Once the size is null, update the offset as to skip the
-                    # rest of the loops
-                    startoffset = self.totalsize + 1
-            start += parentfrag.size
+                    yield Fragment(
+                           offset=parentfrag.getoffset()+startoffset-start,
+                           size=chunksize)
+                # Update startsize and startoffset for the rest of our data
+                startsize -= chunksize
+                startoffset += chunksize
+            index += 1
 
     # Get the projection of an entity as sub entity of an other entity.
     def subentity(self, childent, truncate=False):
-        subentity = _Entity(lpmap=self.longpathmap, maxfstoken=self.maxfstoken)
+        subentity = self._new()
         for childfrag in childent.fragments:
             if childfrag.issparse():
                 subentity.unaryplus(other=childfrag)
@@ -449,14 +664,14 @@ class _Entity:
     def assigntoself(self, other):
         self.fragments = other.fragments
         self.totalsize = other.totalsize
+        self._invalidate()
 
     # Strip the entity of its sparse fragments and sort itsd non sparse
     # fragments.
     # This is meant to be used for reference counting purposes inside of
     # the Box.
     def stripsparse(self):
-        newfragment = _Entity(lpmap=self.longpathmap,
-                              maxfstoken=self.maxfstoken)
+        newfragment = self._new()
         nosparse = []
         for i in range(len(self.fragments)):
             if self.fragments[i].issparse() == False:
@@ -494,25 +709,61 @@ class _Entity:
         rval = float(r[0].totalsize)/float(self.totalsize)
         return rval
 
-    # The range of interest (roi)
+    # The range of interest (roi): the range of parent offsets spanned by
+    # the non sparse data from from_offset onwards. Without non sparse data
+    # at from_offset, the start is None.
     def getroi(self, from_offset):
-        coffset = 0
-        start = None
-        end = None
-        for fragment in self.fragments:
-            if ((not fragment.issparse()) and
-               from_offset <= coffset+fragment.size):
-                if coffset <= from_offset:
-                    start = fragment.offset + from_offset - coffset
-                    end = fragment.offset+fragment.size - 1
-                else:
-                    if start > fragment.offset:
-                        start = fragment.offset
-                    if end < fragment.offset+fragment.size - 1:
-                        end = fragment.offset+fragment.size - 1
-            coffset += fragment.size
+        (starts, sizes, real, minstart, maxend) = self._roiindex()
+        if len(starts) == 0 or from_offset > self.totalsize:
+            return [None, None]
+        index = bisect.bisect_right(starts, from_offset) - 1
+        # The last non sparse fragment that from_offset falls within, or
+        # right at the end of.
+        found = None
+        candidate = index
+        while candidate >= 0 and (starts[candidate] + sizes[candidate] >=
+                                  from_offset):
+            if real[candidate] is not None:
+                found = candidate
+                break
+            candidate -= 1
+        if found is None:
+            return [None, maxend[index + 1]]
+        start = real[found] + from_offset - starts[found]
+        end = real[found] + sizes[found] - 1
+        if minstart[found + 1] is not None:
+            start = min(start, minstart[found + 1])
+            end = max(end, maxend[found + 1])
         return [start, end]
 
+    # Get the (cached) range of interest index: fragment starts and sizes,
+    # parent offsets of non sparse fragments (None for sparse ones) and the
+    # lowest parent start and highest parent end of the non sparse fragments
+    # from each fragment onwards.
+    def _roiindex(self):
+        if self._roi is None:
+            sizes = self._sizes()
+            real = []
+            for fragment in self.fragments:
+                if fragment.issparse():
+                    real.append(None)
+                else:
+                    real.append(fragment.offset)
+            minstart = [None] * (len(real) + 1)
+            maxend = [None] * (len(real) + 1)
+            for index in range(len(real) - 1, -1, -1):
+                minstart[index] = minstart[index + 1]
+                maxend[index] = maxend[index + 1]
+                start = real[index]
+                if start is not None:
+                    end = start + sizes[index] - 1
+                    if minstart[index] is None or start < minstart[index]:
+                        minstart[index] = start
+                    if maxend[index] is None or end > maxend[index]:
+                        maxend[index] = end
+            self._roi = (self._startindex(), sizes, real, minstart, maxend)
+        return self._roi
+
 
 # Helper functions for mapping merge and unmerge to the higher order
 # _fragapply function.
@@ -534,6 +785,14 @@ def _unmerge_entities(ent1, ent2):
 # or non-overlapping fragment and returning an Entity with all fragments that
 # resolved to true for the coresponding lambda.
 def _fragapply(ent1, ent2, bflist=None, test=None):
+    # Large entities are handled by the sweep line engine, as long as it
+    # gives the same result as the walk below.
+    if len(ent1.fragments) + len(ent2.fragments) >= _SWEEP_FRAGMENTS:
+        bounds1 = _bounds(ent1)
+        bounds2 = _bounds(ent2)
+        if _ordered(bounds1) and _ordered(bounds2):
+            return _sweepapply(ent1=ent1, ent2=ent2, bflist=bflist,
+                               test=test, bounds1=bounds1, bounds2=bounds2)
     # If our third argument is a lambda, use it as test instead.
     if test is not None:
         testmode = True
@@ -623,8 +882,7 @@ def _fragapply(ent1, ent2, bflist=None, test=None):
     # Create an array with Entity objects, one per lambda.
     rval = []
     for index in range(0, len(bflist)):
-        rval.append(_Entity(lpmap=ent1.longpathmap,
-                            maxfstoken=ent1.maxfstoken))
+        rval.append(ent1._new())
     # Fill each entity with fragments depending on the appropriate lambda
     # invocation result.
     for index in range(0, len(chunks)):
@@ -638,17 +896,166 @@ def _fragapply(ent1, ent2, bflist=None, test=None):
     return rval
 
 
+# Get the offsets and sizes of all fragments of a sparse free entity.
+def _bounds(ent):
+    if ent.compact:
+        if 1 in ent.fragments.sparse:
+            raise RuntimeError("Sparse doesn't have an offset")
+        return (ent.fragments.offsets, ent.fragments.sizes)
+    return ([frag.getoffset() for frag in ent.fragments],
+            [frag.size for frag in ent.fragments])
+
+
+# Are the fragments in ascending order without overlapping each other? The
+# walk in _fragapply takes the fragments of each entity one at a time in
+# carvpath order, so bytes covered by more than one fragment are visited once
+# per fragment. The sweep counts every byte only once, so it can only stand
+# in for the walk on ordered entities.
+def _ordered(bounds):
+    (offsets, sizes) = bounds
+    if numpy is not None and len(sizes) >= _NUMPY_FRAGMENTS:
+        starts = numpy.array(offsets, dtype=numpy.int64)
+        ends = starts + numpy.array(sizes, dtype=numpy.int64)
+        return bool(numpy.all(starts[1:] >= ends[:-1]))
+    end = None
+    for index in range(0, len(sizes)):
+        if end is not None and offsets[index] < end:
+            return False
+        end = offsets[index] + sizes[index]
+    return True
+
+
+# Sweep over the sorted fragment boundaries of two entities and return the
+# list of [offset, size, inone, intwo] chunks that _fragapply would walk,
+# starting at offset zero.
+def _sweep(bounds1, bounds2):
+    events = []
+    for (offsets, sizes, one, two) in ((bounds1[0], bounds1[1], 1, 0),
+                                       (bounds2[0], bounds2[1], 0, 1)):
+        for index in range(0, len(sizes)):
+            events.append((offsets[index], one, two))
+            events.append((offsets[index] + sizes[index], -one, -two))
+    events.sort()
+    chunks = []
+    masteroffset = 0
+    count1 = 0
+    count2 = 0
+    for (offset, one, two) in events:
+        if offset > masteroffset:
+            chunks.append([masteroffset, offset - masteroffset,
+                           count1 > 0, count2 > 0])
+            masteroffset = offset
+        count1 += one
+        count2 += two
+    return chunks
+
+
+# NumPy version of _sweep. Returns arrays with chunk offsets, chunk sizes and
+# chunk state (2 * inone + intwo).
+def _numpy_sweep(bounds1, bounds2):
+    off1 = numpy.array(bounds1[0], dtype=numpy.int64)
+    off2 = numpy.array(bounds2[0], dtype=numpy.int64)
+    end1 = off1 + numpy.array(bounds1[1], dtype=numpy.int64)
+    end2 = off2 + numpy.array(bounds2[1], dtype=numpy.int64)
+    count1 = len(off1)
+    count2 = len(off2)
+    offsets = numpy.concatenate((off1, end1, off2, end2))
+    ones1 = numpy.ones(count1, dtype=numpy.int64)
+    ones2 = numpy.ones(count2, dtype=numpy.int64)
+    zeros1 = numpy.zeros(2 * count1, dtype=numpy.int64)
+    zeros2 = numpy.zeros(2 * count2, dtype=numpy.int64)
+    delta1 = numpy.concatenate((ones1, -ones1, zeros2))
+    delta2 = numpy.concatenate((zeros1, ones2, -ones2))
+    # Sort the boundaries and keep running counts for both entities.
+    order = numpy.argsort(offsets, kind="mergesort")
+    offsets = offsets[order]
+    depth1 = numpy.cumsum(delta1[order])
+    depth2 = numpy.cumsum(delta2[order])
+    # Only the counts after the last boundary at any offset matter.
+    last = numpy.ones(len(offsets), dtype=bool)
+    last[:-1] = offsets[1:] != offsets[:-1]
+    offsets = offsets[last]
+    state = 2 * (depth1[last] > 0) + (depth2[last] > 0)
+    # Chunk n runs from boundary n-1 (or zero) up to boundary n.
+    starts = numpy.concatenate(([0], offsets[:-1]))
+    sizes = offsets - starts
+    state = numpy.concatenate(([0], state[:-1]))
+    keep = sizes > 0
+    return (starts[keep], sizes[keep], state[keep])
+
+
+# Sweep line implementation of _fragapply. Rather than re-sorting the
+# current fragments for every step, the boundaries of both entities are
+# sorted once. Each boolean lambda is evaluated only for the four possible
+# in-one/in-two combinations and all resulting entities are filled in the
+# same pass.
+def _sweepapply(ent1, ent2, bflist=None, test=None, bounds1=None,
+                bounds2=None):
+    if test is not None:
+        tests = [test]
+    else:
+        tests = bflist
+    # Truth tables indexed by 2 * inone + intwo.
+    tables = []
+    for bf in tests:
+        tables.append([bool(bf(False, False)), bool(bf(False, True)),
+                       bool(bf(True, False)), bool(bf(True, True))])
+    if bounds1 is None:
+        bounds1 = _bounds(ent1)
+    if bounds2 is None:
+        bounds2 = _bounds(ent2)
+    rval = []
+    if (numpy is not None and
+       len(bounds1[1]) + len(bounds2[1]) >= _NUMPY_FRAGMENTS):
+        (starts, sizes, state) = _numpy_sweep(bounds1, bounds2)
+        for table in tables:
+            selected = numpy.array(table)[state]
+            if test is not None:
+                return bool(selected.any())
+            # Coalesce directly adjacent selected chunks.
+            runstarts = starts[selected]
+            runends = runstarts + sizes[selected]
+            newrun = numpy.ones(len(runstarts), dtype=bool)
+            newrun[1:] = runstarts[1:] != runends[:-1]
+            lastinrun = numpy.ones(len(runstarts), dtype=bool)
+            lastinrun[:-1] = newrun[1:]
+            runstarts = runstarts[newrun].tolist()
+            runsizes = (runends[lastinrun] - runstarts).tolist()
+            ent = ent1._new()
+            for index in range(0, len(runstarts)):
+                ent.unaryplus(other=Fragment(offset=runstarts[index],
+                                             size=runsizes[index]))
+            rval.append(ent)
+        return rval
+    chunks = _sweep(bounds1, bounds2)
+    if test is not None:
+        for chunk in chunks:
+            if tables[0][2 * chunk[2] + chunk[3]]:
+                return True
+        return False
+    for table in tables:
+        rval.append(ent1._new())
+    for chunk in chunks:
+        state = 2 * chunk[2] + chunk[3]
+        for index in range(0, len(tables)):
+            if tables[index][state]:
+                rval[index].unaryplus(other=Fragment(offset=chunk[0],
+                                                     size=chunk[1]))
+    return rval
+
+
 # This object allows an Entity to be validated against an underlying data
 # source with a given size.
 class _Top:
     # Don instantiate a _Top, Instantiate a Context and use
     # Context::make_top instead.
-    def __init__(self, lpmap, maxfstoken, size=0):
+    def __init__(self, lpmap, maxfstoken, size=0, compact=False):
         self.size = size
         self.topentity = _Entity(lpmap=lpmap,
                                  maxfstoken=maxfstoken,
                                  fragments=[Fragment(offset=0,
-                                                     size=size)])
+                                                     size=size)],
+                                 compact=compact)
 
     # Get this Top object as an Entity.
     def entity():
@@ -679,21 +1086,57 @@ class Context:
     # by a 65 byte long token stored in this pseudo dict. You may specify a
     # different maximum carvpath lengt if you wish for a longer or shorter
     # treshold.
-    def __init__(self, lpmap, maxtokenlen=160):
+    # With compact set, entities store their fragments in parallel arrays
+    # rather than as Fragment/Sparse objects. This uses a lot less memory for
+    # large numbers of active entities.
+    # A non zero cachesize enables an LRU cache of up to cachesize parsed
+    # carvpaths.
+    def __init__(self, lpmap, maxtokenlen=160, compact=False, cachesize=0):
         self.longpathmap = lpmap
         self.maxfstoken = maxtokenlen
+        self.compact = compact
+        self.cachesize = cachesize
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     # Parse a (possibly nested) carvpath and return an Entity object.
     # This method will throw if a carvpath string is invalid. It will however
     # NOT set any upper limits to valid carvpaths within a larger image.
     # If you wish to do so, create a Top object and invoke Top::test(ent) with
     # the Entity you got back from parse.
+    # With the parse cache enabled, the parsed entities are kept unaltered in
+    # the cache and parse returns copy-on-write clones of them, so callers
+    # may still modify the entity they get back.
     def parse(self, path):
+        if self.cachesize < 1:
+            return self._parse(path)
+        if path in self.cache:
+            # Move to the most recently used end of the cache.
+            ent = self.cache.pop(path)
+            self.cache[path] = ent
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+            ent = self._parse(path)
+            self.cache[path] = ent
+            if len(self.cache) > self.cachesize:
+                # Drop the least recently used entity.
+                self.cache.popitem(last=False)
+        return ent._cowclone()
+
+    # Parse cache statistics: hits, misses, cached entities and cache size.
+    def cache_info(self):
+        return (self.cache_hits, self.cache_misses, len(self.cache),
+                self.cachesize)
+
+    def _parse(self, path):
         levelmin = None
         for level in path.split("/"):
             level = _Entity(lpmap=self.longpathmap,
                             maxfstoken=self.maxfstoken,
-                            carvpath=level)
+                            carvpath=level,
+                            compact=self.compact)
             if levelmin is not None:
                 level = levelmin.subentity(childent=level)
             levelmin = level
@@ -701,15 +1144,32 @@ class Context:
 
     # Cheate a Top object to validate parsed entities against.
     def make_top(self, size=0):
-        return _Top(self.longpathmap, self.maxfstoken, size)
+        return _Top(self.longpathmap, self.maxfstoken, size, self.compact)
 
     def empty(self):
-        return _Entity(lpmap=self.longpathmap, maxfstoken=self.maxfstoken)
+        return _Entity(lpmap=self.longpathmap, maxfstoken=self.maxfstoken,
+                       compact=self.compact)
 
 
 class _Test:  # pragma: no cover
-    def __init__(self, lpmap, maxtokenlen):
-        self.context = Context(lpmap, maxtokenlen)
+    def __init__(self, lpmap, maxtokenlen, compact=False):
+        self.compact = compact
+        self.context = Context(lpmap, maxtokenlen, compact)
+
+    def testparsecache(self, pin, pgrow):
+        context = Context({}, compact=self.compact, cachesize=2)
+        a = context.parse(pin)
+        b = context.parse(pin)
+        # Changing one clone should leave other clones and the cache alone.
+        a.unaryplus(other=context.parse(pgrow))
+        b.grow(chunksize=1000)
+        c = context.parse(pin)
+        if str(c) != str(context._parse(pin)) or context.cache_hits != 2:
+            print("FAIL: parse cache in='" + pin + "' result='" + str(c) +
+                  "' info=" + str(context.cache_info()))
+        else:
+            print("OK: parse cache in='" + pin + "' result='" + str(c) +
+                  "' info=" + str(context.cache_info()))
 
     def testadd(self, pin1, pin2, pout):
         a = self.context.parse(pin1)
@@ -754,7 +1214,7 @@ class _Test:  # pragma: no cover
         self.testflatten2(context, pin, pout)
 
     def testrange(self, topsize, carvpath, expected):
-        context = Context({})
+        context = Context({}, compact=self.compact)
         top = context.make_top(topsize)
         entity = context.parse(carvpath)
         if top.test(entity) != expected:
@@ -776,7 +1236,7 @@ class _Test:  # pragma: no cover
 
     def testmerge(self, p1, p2, pout):
         print("TESTMERGE:")
-        context = Context({})
+        context = Context({}, compact=self.compact)
         a = context.parse(p1)
         a.stripsparse()
         b = context.parse(p2)
@@ -861,4 +1321,78 @@ if __name__ == "__main__":  # pragma: no cover
     t.testmerge("500+2000", "0+1000_2000+1000", "0+3000")
     t.testmerge("0+1000_2000+1000", "500+1000", "0+1500_2000+1000")
     t.testmerge("S0", "0+1000_2000+1000", "0+1000_2000+1000")
+    t.testparsecache("0+1000_S2000_1000+2000", "3000+1000")
     t.testmerge("0+60000", "15000+30000", "0+60000")
+    # The same checks on compact entities.
+    context = Context(lpmap, compact=True)
+    t = _Test(lpmap, 160, compact=True)
+    t.testflatten(context, "0+0/0+0", "S0")
+    t.testflatten(context, "S100_S200", "S300")
+    t.testflatten(context, "0+20000_20000+20000/10000+30000", "10000+30000")
+    t.testflatten(context, "0+20000_40000+20000/10000+20000/5000+10000/"
+                           "2500+5000/1250+2500/625+1250",
+                           "19375+625_40000+625")
+    t.testflatten(context, "D901141262aa24eaaddbce2f470615b6a47639f7a62b3bc7c"
+                           "65335251fe3fa480/350+100", "353+50_404+50")
+    t.testflatten(context, "S200000/1000+9000", "S9000")
+    t.testrange(200000000000, "0+100000000000/0+50000000", True)
+    t.testrange(20000, "0+100000000000/0+50000000", False)
+    t.testsize(context, "0+20000_40000+20000/10000+20000/5000+10000", 10000)
+    t.teststripsparse("4000+2000_S2000_0+1000", "0+1000_4000+2000")
+    t.testadd("0+1000_S2000", "S1000_3000+1000", "0+1000_S3000_3000+1000")
+    t.testmerge("2000+1000_5000+100",
+                "100+500_800+800_4000+200_6000+100_7000+100",
+                "100+500_800+800_2000+1000_4000+200_5000+100_6000+100_7000"
+                "+100")
+    t.testmerge("0+1000_2000+1000", "500+1000", "0+1500_2000+1000")
+    t.testparsecache("0+1000_S2000_1000+2000", "3000+1000")
+    # Differential test of the sweep line engine against the walk, with
+    # ordered entities as well as unordered and self-overlapping ones.
+    import random
+    random.seed(42)
+
+    def random_entity(context, count, ordered):
+        frags = []
+        offset = random.randint(0, 1000)
+        for index in range(0, count):
+            size = random.randint(1, 1000)
+            frags.append(str(offset) + "+" + str(size))
+            if ordered:
+                offset += size + random.randint(1, 1000)
+            else:
+                offset = max(0, offset + random.randint(-1500, 1500))
+        return context.parse("_".join(frags))
+    lambdas = [(lambda a, b: a or b),
+               (lambda a, b: a and b),
+               (lambda a, b: a and not b),
+               (lambda a, b: (not a) and b),
+               (lambda a, b: a != b)]
+    failed = False
+    sweepfragments = _SWEEP_FRAGMENTS
+    numpyfragments = _NUMPY_FRAGMENTS
+    for compact in [False, True]:
+        context = Context(lpmap, compact=compact)
+        for step in range(0, 100):
+            ent1 = random_entity(context, random.randint(1, 300),
+                                 random.random() < 0.5)
+            ent2 = random_entity(context, random.randint(1, 300),
+                                 random.random() < 0.5)
+            results = []
+            for (sweep, vectorize) in [(10 ** 9, 10 ** 9), (2, 10 ** 9),
+                                       (2, 2)]:
+                _SWEEP_FRAGMENTS = sweep
+                _NUMPY_FRAGMENTS = vectorize
+                result = [str(ent) for ent in
+                          _fragapply(ent1, ent2, bflist=lambdas)]
+                result.append(_fragapply(ent1, ent2,
+                                         test=(lambda a, b: a and b)))
+                results.append(result)
+            _SWEEP_FRAGMENTS = sweepfragments
+            _NUMPY_FRAGMENTS = numpyfragments
+            if results[1] != results[0] or results[2] != results[0]:
+                print("FAIL: sweep differs from walk for " + str(ent1) +
+                      " and " + str(ent2))
+                failed = True
+                break
+    if not failed:
+        print("OK: sweep matches walk")
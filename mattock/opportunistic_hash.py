@@ -29,6 +29,7 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE
 #
 import copy
+import rangeindex
 
 
 try:
@@ -53,6 +54,9 @@ try:  # pragma: no cover
 except:  # pragma: no cover
     pass
 
+# Shared read-only zeroes for hashing sparse data.
+_ZEROES = memoryview(b"\0" * 65536)
+
 
 # Opportunistic hashing state for a single fixed-size entity
 class _Opportunistic_Hash:
@@ -69,8 +73,12 @@ class _Opportunistic_Hash:
 
     # A sparse chunk
     def sparse(self, length, offset):
-        # Process as a chunk of read zeroes.
-        self.read_chunk(data=bytearray(length), offset=offset)
+        # Process as chunks of read zeroes.
+        while length > 0:
+            size = min(length, len(_ZEROES))
+            self.read_chunk(data=_ZEROES[:size], offset=offset)
+            offset += size
+            length -= size
 
     # Indicate that mutable entity won't be written to any more times.
     def freeze(self):
@@ -158,13 +166,27 @@ class _OH_Entity:
            parentoffset < roi[1] and
            parentendoffset > roi[0]):
             childoffset = 0  # Start of with a child offset of zero.
+            index = 0
+            fragments = self.ent.fragments
+            if not writemode:
+                # Reading can't move the hash along for fragments before the
+                # one holding the hashing offset. If that one is sparse, start
+                # at the non sparse fragment before it; whether that overlaps
+                # decides if the sparse data gets hashed.
+                (index, childoffset) = self.ent.fragment_at(
+                                         offset=self.ohash.offset)
+                while index > 0 and fragments[index].issparse():
+                    index -= 1
+                    childoffset -= fragments[index].size
             working = False  # Marks if we are working on the hash.
             updated = False  # This indicates that the hash has been updated
             #                  in this read_parent_chunk invocation.
             wasdone = self.ohash.isdone
             # Look at the parent chunk for all the fragments that make up the
             # CarvPath entity.
-            for fragment in self.ent.fragments:
+            while index < len(fragments):
+                fragment = fragments[index]
+                index += 1
                 # First look at real fragments.
                 if not fragment.issparse():
                     lastbyte = fragment.offset + fragment.size - 1
@@ -203,6 +225,10 @@ class _OH_Entity:
                         updated = True
                     else:
                         working = False
+                        if (not writemode and
+                           childoffset >= self.ohash.offset):
+                            # Reading past the hashing offset is no use.
+                            break
                 else:
                     if working:
                         # Only process sparse sections if we are in the
@@ -262,29 +288,92 @@ class OpportunisticHashCollection:
         self.log = open(ohash_log, "a", 0)  # Open a log file to keep track of
         #                                     successfull opportunistic hashing
         self.mtlog = mtlog #Experimental merkletree logging for opportunistic hashing.
+        # Callables to notify of carvpaths whose hashing offset moved.
+        self.listeners = []
+        # Index of unfinished candidates by the start of their read range of
+        # interest (the hashing frontier), and by their write range of
+        # interest, so low level reads and writes only visit candidates
+        # they might matter to.
+        self.readindex = rangeindex.SortedOffsets()
+        self.readkeys = dict()
+        self.writeindex = rangeindex.RangeIndex()
+        self.writekeys = dict()
+        # Carvpaths of mutable entities that haven't been frozen yet.
+        self.unfrozen = set()
 
     # Add a new carvpath to the collection.
     def add_carvpath(self, carvpath):
         # Parse the carvpath.
         ent = self.context.parse(path=carvpath)
+        if carvpath in self.ohash:
+            self._unindex(carvpath=carvpath)
         # Create a new opportunistic hashing candidate.
         self.ohash[carvpath] = _OH_Entity(entity=ent, log=self.log, mtlog=self.mtlog)
+        # The write range of interest doesn't move, index it once. With a
+        # leading sparse fragment there is no start to the range of interest,
+        # any write before its end may matter.
+        writeroi = self.ohash[carvpath].writeroi
+        if writeroi[1] is not None:
+            start = writeroi[0]
+            if start is None:
+                start = 0
+            self.writekeys[carvpath] = (start, writeroi[1] + 1)
+            self.writeindex.add(start, writeroi[1] + 1, carvpath)
+        self._reindex(carvpath=carvpath)
 
     # Drop a candidate from the collection.
     def remove_carvpath(self, carvpath):
+        self._unindex(carvpath=carvpath)
+        self.unfrozen.discard(carvpath)
         del self.ohash[carvpath]
 
+    # Drop a candidate from the read and write indices.
+    def _unindex(self, carvpath):
+        if carvpath in self.readkeys:
+            self.readindex.remove((self.readkeys.pop(carvpath), carvpath))
+        if carvpath in self.writekeys:
+            (start, end) = self.writekeys.pop(carvpath)
+            self.writeindex.remove(start, end, carvpath)
+
+    # Update the read index after the range of interest of a candidate may
+    # have moved. Finished candidates leave both indices. If the hashing
+    # offset from before the update is given, listeners get notified when
+    # it moved.
+    def _reindex(self, carvpath, hashoffset=None):
+        entity = self.ohash[carvpath]
+        if hashoffset is not None and entity.hashing_offset() != hashoffset:
+            for listener in self.listeners:
+                listener(carvpath)
+        if entity.hashing_isdone():
+            self._unindex(carvpath=carvpath)
+            return
+        if carvpath in self.readkeys:
+            if self.readkeys[carvpath] == entity.roi[0]:
+                return
+            self.readindex.remove((self.readkeys.pop(carvpath), carvpath))
+        if entity.roi[0] is not None:
+            self.readkeys[carvpath] = entity.roi[0]
+            self.readindex.add((entity.roi[0], carvpath))
+
     # Process data written to the underlying data archive.
     def lowlevel_written_data(self, offset, data):
-        for carvpath in self.ohash.keys():
+        # Only candidates whose write range of interest overlaps the data.
+        for carvpath in self.writeindex.overlapping(offset,
+                                                    offset + len(data)):
+            hashoffset = self.ohash[carvpath].hashing_offset()
             self.ohash[carvpath].written_parent_chunk(data=data,
                                                       parentoffset=offset)
+            self._reindex(carvpath=carvpath, hashoffset=hashoffset)
 
     # Process data read from the underlying data archive.
     def lowlevel_read_data(self, offset, data):
-        for carvpath in self.ohash.keys():
+        # Only candidates with their hashing frontier inside the data.
+        for (roistart, carvpath) in self.readindex.irange(
+                                      (offset,), (offset + len(data) - 1,)):
+            hashoffset = self.ohash[carvpath].hashing_offset()
             self.ohash[carvpath].read_parent_chunk(data=data,
                                                    parentoffset=offset)
+            self._reindex(carvpath=carvpath, hashoffset=hashoffset)
 
     # Query if hashing for a given CarvPath has fully completed.
     def hashing_isdone(self, carvpath):
@@ -299,15 +388,25 @@ class OpportunisticHashCollection:
     def hashing_offset(self, carvpath):
         return self.ohash[carvpath].hashing_offset()
 
+    # Indicate that a newly allocated carvpath is a mutable entity that is
+    # still being written to.
+    def mutable(self, carvpath):
+        self.unfrozen.add(carvpath)
+
     # Indicate that a mutable entity has just been frozen and no more writes
     # shall occur.
     def freeze(self, carvpath):
+        self.unfrozen.discard(carvpath)
+        hashoffset = self.ohash[carvpath].hashing_offset()
         self.ohash[carvpath].freeze()
+        self._reindex(carvpath=carvpath, hashoffset=hashoffset)
 
 if __name__ == "__main__":  # pragma: no cover
     import carvpath
+    import merkletree
     context = carvpath.Context({}, 160)
-    ohc = OpportunisticHashCollection(context, "./test.log")
+    ohc = OpportunisticHashCollection(context, "./test.log",
+                                      merkletree.MerkleTreeLog("./test3.log"))
 
     ohc.add_carvpath("10+5")  # 10,11,12,13,14
     ohc.add_carvpath("13+5")  # 13,14,15,16,17
@@ -31,7 +31,6 @@
 # This file is a place holder for a future provenance loging facility.
 #
 import time
-import json
 from pyblake2 import blake2b
 import bencode
 import datetime
@@ -73,9 +72,8 @@ class ProvenanceLog:
         if restore is False:
             # Create a journal log record
             journal_rec = {"type": "NEW", "key": self.key, "provenance": rec}
-            # Write the record synchonously to the journal.
-            self.journal.write(json.dumps(journal_rec,sort_keys=True))
-            self.journal.write("\n")
+            # Hand the record to the journal.
+            self.journal.append(journal_rec)
     def __del__(self):
         # When the ProvenanceLog object is deleted, create one last record.
         rec = {}
@@ -87,8 +85,7 @@ class ProvenanceLog:
         # Create a journal record.
         journal_rec = {"type": "FNL", "key": key, "provenance" : rec}
         # Write it to the journal.
-        self.journal.write(json.dumps(journal_rec,sort_keys=True))
-        self.journal.write("\n")
+        self.journal.append(journal_rec)
         # Create object that can be signed canonically
         hsh = ""
         if self.mt != None and len(self.log) > 0 and "jobid" in self.log[0] and "carvpath" in self.log[0]:
@@ -103,8 +100,7 @@ class ProvenanceLog:
             print "ERR",self.mt != None,len(self.log) > 0,"jobid" in self.log[0],"carvpath" in self.log[0]
         rec = { "hsh" : hsh, "provenance" : self.log }
         # Write the full provenance log to the provenance logging file.
-        self.provenance.write(json.dumps(rec,sort_keys=True))
-        self.provenance.write("\n")
+        self.provenance.append(rec)
     def __call__(self, jobid, actor, router_state="", restore=False,command=None, user=None):
         newobj = {"jobid": jobid,
                   "actor": actor,
@@ -126,8 +122,7 @@ class ProvenanceLog:
                            "key": key,
                            "provenance": newobj}
             # And write it to the jounal log.
-            self.journal.write(json.dumps(journal_rec,sort_keys=True))
-            self.journal.write("\n")
+            self.journal.append(journal_rec)
     def accept(self,actor,command,user):
         newobj = {"actor": actor,
                   "time" : datetime.datetime.now().isoformat(),
@@ -138,8 +133,7 @@ class ProvenanceLog:
         journal_rec = {"type" : "UPD",
                        "key"  : self.key,
                        "provenance" : newobj }
-        self.journal.write(json.dumps(journal_rec,sort_keys=True))
-        self.journal.write("\n")
+        self.journal.append(journal_rec)
     def restorepoint(self):
         # Retreive the unique key to use in the journal.
         key = self.key
@@ -148,7 +142,6 @@ class ProvenanceLog:
                        "key": key,
                        "provenance": self.log}
         # And write it to the jounal log.
-        self.journal.write(json.dumps(journal_rec,sort_keys=True))
-        self.journal.write("\n")
+        self.journal.append(journal_rec)
 
 
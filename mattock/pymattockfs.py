@@ -45,6 +45,8 @@ import os
 import redislongpathmap as longpathmap
 import pwd
 import json
+import threading
+import time
 
 fuse.fuse_python_api = (0, 2)
 
@@ -61,6 +63,28 @@ STAT_MODE_FILE = (stat.S_IFREG | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH |
 STAT_MODE_FILE_RO = stat.S_IFREG | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
 
 
+# Read the MattockFS config file. Returns an empty config if there is none.
+def get_config():
+    try:
+        with open("/etc/mattockfs.json", "r") as config_file:
+            return json.loads(config_file.read())
+    except (IOError, ValueError):
+        return {}
+
+
+# Decorator for fuse hooks. The file system itself is single threaded, but
+# background hash completion runs in a thread of its own, so fuse hooks and
+# background work must take turns. Also keeps track of when we were last
+# busy.
+def _serialized(method):
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            self.lastop = time.time()
+            return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
 # Generate a decent stat object.
 def defaultstat(mode=STAT_MODE_DIR_NOLIST, size=0):
     st = fuse.Stat()
@@ -220,10 +244,12 @@ class EtcDir:
 
 # Top level mattockfs.ctl control file.
 class TopCtl:
-    def __init__(self, rep, context, mtlog):
+    def __init__(self, rep, context, mtlog, hasher, actors):
         self.rep = rep
+        self.actors = actors
         self.context = context
         self.mtlog = mtlog
+        self.hasher = hasher
 
     def getattr(self):
         return defaultstat(STAT_MODE_FILE_RO)
@@ -238,6 +264,12 @@ class TopCtl:
         return ["user.fadvise_status",
                 "user.full_archive",
                 "user.add_longpath",
+                "user.parse_cache_status",
+                "user.block_cache_status",
+                "user.tier_cache_status",
+                "user.hash_budget",
+                "user.hash_completion_status",
+                "user.anycast_status",
                 "user.tick"]
 
     def getxattr(self, name, size):
@@ -250,6 +282,37 @@ class TopCtl:
             return "carvpath/" + str(self.rep.top.topentity) + ".raw"
         if name == "user.add_longpath":
             return ""
+        if name == "user.parse_cache_status":
+            # Get hits, misses, entries and size of the carvpath parse cache.
+            return ";".join(map(lambda x: str(x),
+                                self.context.cache_info()))
+        if name == "user.block_cache_status":
+            # Get hits, misses, cached blocks and byte budget of the archive
+            # block cache.
+            status = [0, 0, 0, 0]
+            if self.rep.cache is not None:
+                status = self.rep.cache.status()
+            return ";".join(map(lambda x: str(x), status))
+        if name == "user.tier_cache_status":
+            # Get hits, misses, staged blocks, blocks waiting to be staged,
+            # average staging lag in milliseconds and byte budget of the
+            # tier cache.
+            status = [0, 0, 0, 0, 0, 0]
+            if self.rep.tier is not None:
+                status = self.rep.tier.status()
+            return ";".join(map(lambda x: str(x), status))
+        if name == "user.hash_budget":
+            # Background hash completion I/O budget in bytes per second.
+            return str(self.hasher.budget)
+        if name == "user.hash_completion_status":
+            # Get pending candidates, completed hashes and bytes read by
+            # background hash completion.
+            return ";".join(map(lambda x: str(x),
+                                self.hasher.status()))
+        if name == "user.anycast_status":
+            # Get the job count and volume of all anycast sets together.
+            return ";".join(map(lambda x: str(x),
+                                self.actors.throttle_info()))
         if name == "user.tick":
             self.mtlog.tick()
             return ""
@@ -258,8 +321,22 @@ class TopCtl:
     def setxattr(self, name, val):  # pragma: no cover
         if name in ("user.fadvise_status",
                     "user.full_archive",
+                    "user.parse_cache_status",
+                    "user.block_cache_status",
+                    "user.tier_cache_status",
+                    "user.hash_completion_status",
+                    "user.anycast_status",
                     "user.tick"):
             return -errno.EPERM
+        if name == "user.hash_budget":
+            try:
+                budget = int(val)
+            except ValueError:
+                return -errno.EINVAL
+            if budget < 0:
+                return -errno.EINVAL
+            self.hasher.budget = budget
+            return 0
         if name == "user.add_longpath":
             val = val.split("carvpath/")[-1].split(".")[0]
             altval = str(self.context.parse(val))
@@ -408,15 +485,16 @@ class WorkerCtl:
         return -errno.EINVAL
 
     def listxattr(self):  # pragma: no cover
+        rval = ["user.job_select_policy",
+                "user.unregister",
+                "user.accept_job",
+                "user.batch_size",
+                "user.accept_batch"]
         if self.loadbalance_ok == True :
-            return ["user.job_select_policy",
-                    "user.actor_select_policy",
-                    "user.unregister",
-                    "user.accept_job"]
-        else:
-            return ["user.job_select_policy",
-                    "user.unregister",
-                    "user.accept_job"]
+            rval.insert(1, "user.actor_select_policy")
+        if self.worker.notifier is not None:
+            rval.append("user.notify_fifo")
+        return rval
 
     def getxattr(self, name, size):  # pragma: no cover
         if name == "user.job_select_policy":
@@ -440,6 +518,26 @@ class WorkerCtl:
                     return -errno.ENODATA
                 self.tick()
                 return "job/" + job + ".ctl"
+        if name == "user.batch_size":
+            return str(self.worker.batch_size)
+        if name == "user.accept_batch":
+            if size == 0:
+                # Don't accidently accept jobs with listxattr, leave room for
+                # a full batch of job ctl paths.
+                return 78 * self.worker.batch_size
+            else:
+                # Accept up to batch_size jobs for worker at once.
+                jobs = self.worker.accept_jobs(count=self.worker.batch_size)
+                if len(jobs) == 0:
+                    return -errno.ENODATA
+                for job in jobs:
+                    self.tick()
+                return ";".join(["job/" + job + ".ctl" for job in jobs])
+        if name == "user.notify_fifo":
+            # Named pipe to block on while there are no jobs to accept.
+            if self.worker.notifier is not None:
+                return self.worker.notifier.path
+            return -errno.ENODATA
         return -errno.ENODATA
 
     def setxattr(self, name, val):
@@ -468,6 +566,19 @@ class WorkerCtl:
             return 0
         if name == "user.accept_job":  # pragma: no cover
             return -errno.EPERM
+        if name == "user.batch_size":
+            try:
+                asnum = int(val)
+            except ValueError:
+                return 0
+            # Keep the batch within the xattr value size limit.
+            if asnum > 0 and asnum <= 512:
+                self.worker.batch_size = asnum
+            return 0
+        if name == "user.accept_batch":  # pragma: no cover
+            return -errno.EPERM
+        if name == "user.notify_fifo":  # pragma: no cover
+            return -errno.EPERM
         return -errno.ENODATA
 
     def open(self, flags, path):  # pragma: no cover
@@ -492,23 +603,23 @@ class JobCtl:
     def listxattr(self):  # pragma: no cover
         return ["user.routing_info",
                 "user.submit_child",
+                "user.submit_children",
                 "user.allocate_mutable",
                 "user.frozen_mutable",
                 "user.current_mutable",
-                "user.job_carvpath"]
+                "user.job_carvpath",
+                "user.job_descriptor"]
 
     def getxattr(self, name, size):
         if name == "user.routing_info":
             # Compose routing info string from actor name, router state
             # and mime_type.
-            print self.job
-            print self.job.actorname
-            print self.job.router_state
-            print self.job.mime_type
             return (self.job.actorname + ";" + self.job.router_state +
                     ";" + self.job.mime_type)
         if name == "user.submit_child":  # pragma: no cover
             return ""
+        if name == "user.submit_children":  # pragma: no cover
+            return ""
         if name == "user.allocate_mutable":  # pragma: no cover
             return ""
         if name == "user.current_mutable":
@@ -531,6 +642,23 @@ class JobCtl:
             # worker that initiated the tool chain.
             return ("carvpath/" +
                     self.job.carvpath + "." + self.job.file_extension)
+        if name == "user.job_descriptor":
+            # Everything a worker needs to start on the job as one JSON
+            # record, saving it a handful of round trips.
+            col = self.job.col
+            return json.dumps({
+                "actor": self.job.actorname,
+                "router_state": self.job.router_state,
+                "mime_type": self.job.mime_type,
+                "extension": self.job.file_extension,
+                "carvpath": ("carvpath/" + self.job.carvpath + "." +
+                             self.job.file_extension),
+                "size": self.job.volume,
+                "hash": col.hashing_value(carvpath=self.job.carvpath),
+                "hash_done": col.hashing_isdone(carvpath=self.job.carvpath),
+                "hash_offset": col.hashing_offset(
+                                 carvpath=self.job.carvpath)},
+                sort_keys=True)
         return -errno.ENODATA
 
     def setxattr(self, name, val):
@@ -551,12 +679,25 @@ class JobCtl:
                                       extension=parts[4])
                 self.tick()
             return 0
+        if name == "user.submit_children":
+            # One child per line, each formatted like for submit_child.
+            children = []
+            for line in val.split("\n"):
+                parts = line.split(";")
+                if len(parts) == 5:
+                    children.append(parts)
+            if len(children) > 0:
+                self.job.submit_children(children=children)
+                for child in children:
+                    self.tick()
+            return 0
         if name == "user.allocate_mutable":
             # Create a mutable of the given size.
             self.job.create_mutable(msize=int(val))
             return 0
         if name in ("user.frozen_mutable",
-                    "user.job_carvpath"):  # pragma: no cover
+                    "user.job_carvpath",
+                    "user.job_descriptor"):  # pragma: no cover
             return -errno.EPERM
         return -errno.ENODATA
 
@@ -736,24 +877,50 @@ class EtcLink:
 # The actual FUSE MattockFS file-system.
 class MattockFS(fuse.Fuse):
     def __init__(self, dash_s_do, version, usage, dd, lpdb, journal,
-                 provenance_log, ohash_log, refcount_log, mtlog):
+                 provenance_log, ohash_log, refcount_log, mtlog, conf=None,
+                 notify_dir=None):
         super(MattockFS, self).__init__(version=version, usage=usage,
                                         dash_s_do=dash_s_do)
+        if conf is None:
+            conf = {}
         self.longpathdb = lpdb
-        self.context = carvpath.Context(lpmap=self.longpathdb)
+        # Compact entities keep their fragments in arrays, saving memory
+        # with many active carvpaths. The parse cache saves us from parsing
+        # the same carvpaths over and over again.
+        self.context = carvpath.Context(
+            lpmap=self.longpathdb,
+            compact=conf.get("compact_carvpaths", False),
+            cachesize=conf.get("parse_cache_size", 4096))
         self.topdir = TopDir()
         self.nolistdir = NoList()
         # Regular expressions for select policies.
         self.selectre = re.compile(r'^[SVDWC]{1,5}$')
         self.sortre = re.compile(r'^(K|[RrOHDdWS]{1,6})$')
         self.archive_dd = dd
+        # Hot data cache file on fast storage, if configured.
+        tier_cache = None
+        if "tier_cache_dir" in conf:
+            tier_cache = (conf["tier_cache_dir"] + "/" +
+                          os.path.basename(dd) + ".cache")
         self.mtlog = merkletree.MerkleTreeLog(mtlog)
         self.rep = repository.Repository(
             reppath=self.archive_dd,
             context=self.context,
             ohash_log=ohash_log,
             refcount_log=refcount_log,
-            mtlog = self.mtlog)
+            mtlog = self.mtlog,
+            refcount_map=conf.get("refcount_map", False),
+            mmap_archive=conf.get("mmap_archive", False),
+            block_cache=conf.get("block_cache_size", 0),
+            arena_size=conf.get("arena_size", 0),
+            durability=conf.get("durability", "strict"),
+            commit_interval=conf.get("commit_interval", 1.0),
+            write_buffer=conf.get("write_buffer_size", 0),
+            stripes=[directory + "/" + os.path.basename(dd)
+                     for directory in conf.get("archive_stripes", [])],
+            stripe_size=conf.get("stripe_size", 1048576),
+            tier_cache=tier_cache,
+            tier_cache_size=conf.get("tier_cache_size", 0))
         self.ms = anycast.Actors(
             rep=self.rep,
             journal=journal,
@@ -761,9 +928,21 @@ class MattockFS(fuse.Fuse):
             context=self.context,
             stack=self.rep.stack,
             col=self.rep.col,
-            mt=self.mtlog)
+            mt=self.mtlog,
+            notify_dir=notify_dir,
+            journal_buffer=conf.get("journal_buffer_size", 0),
+            journal_interval=conf.get("journal_interval", 1.0),
+            journal_durability=conf.get("journal_durability", "none"))
+        # Idle-time completion of stalled opportunistic hashes.
+        self.hasher = repository.HashCompleter(
+            rep=self.rep,
+            budget=conf.get("hash_budget", 0))
+        self.lock = threading.Lock()
+        self.lastop = time.time()
         self.etcdir = EtcDir()
-        self.topctl = TopCtl(rep=self.rep, context=self.context, mtlog=self.mtlog)
+        self.topctl = TopCtl(rep=self.rep, context=self.context,
+                             mtlog=self.mtlog, hasher=self.hasher,
+                             actors=self.ms)
         self.actordir = ActorDir(actors=self.ms)
         self.needinit = True
     # Helper used by multiple fuse hooks to create one of the node type
@@ -865,33 +1044,41 @@ class MattockFS(fuse.Fuse):
         return NoEnt()
 
     # Forward getattr to parsepath result.
+    @_serialized
     def getattr(self, path):
         return self.parsepath(path).getattr()
 
     # Do nothing on setattr.
+    @_serialized
     def setattr(self, path, hmm):
         return 0
 
     # Forward
+    @_serialized
     def opendir(self, path):
         return self.parsepath(path).opendir()
 
     # Forward
+    @_serialized
     def readdir(self, path, offset):
         return self.parsepath(path).readdir()
 
     # Do nothing on releasedir.
+    @_serialized
     def releasedir(self, path):
         return 0
 
     # Forward
+    @_serialized
     def readlink(self, path):
         return self.parsepath(path).readlink()
 
     # Forward
+    @_serialized
     def listxattr(self, path, huh):
         return self.parsepath(path).listxattr()
 
+    @_serialized
     def getxattr(self, path, name, size):
         rval = self.parsepath(path).getxattr(name, size)
         if isinstance(rval, int) and rval < 0:
@@ -904,35 +1091,86 @@ class MattockFS(fuse.Fuse):
         return rval
 
     # Forward
+    @_serialized
     def setxattr(self, path, name, val, more):
         return self.parsepath(path).setxattr(name, val)
 
     def main(self, args=None):
         fuse.Fuse.main(self, args)
 
+    # Called once the file system is up and running (and daemonized); start
+    # background hash completion.
+    def fsinit(self):
+        hasher = threading.Thread(target=self.hash_completion)
+        hasher.daemon = True
+        hasher.start()
+        committer = threading.Thread(target=self.durability_commit)
+        committer.daemon = True
+        committer.start()
+
+    # Called on unmount; write out buffered journal records, commit and give
+    # back the unused part of our archive arena.
+    def fsdestroy(self):
+        with self.lock:
+            self.ms.journal.flush()
+            self.ms.provenance_log.flush()
+            self.rep.durability.commit()
+            self.rep.close_arena()
+
+    # Background hash completion loop, only does work after the file system
+    # has been idle for a little while.
+    def hash_completion(self):
+        while True:
+            time.sleep(0.1)
+            with self.lock:
+                if time.time() - self.lastop > 0.5:
+                    self.hasher.step()
+
+    # Background loop committing flushed data for the data and group
+    # durability policies, and writing out journal and provenance records
+    # that have been buffered for too long. The pending ranges and records
+    # get written under the lock, the slow fdatasyncs are done without
+    # holding it.
+    def durability_commit(self):
+        while True:
+            time.sleep(0.1)
+            with self.lock:
+                ranges = self.rep.durability.step()
+                journalfd = self.ms.journal.step()
+                provenancefd = self.ms.provenance_log.step()
+            self.rep.durability.sync(ranges=ranges)
+            self.ms.journal.sync(fd=journalfd)
+            self.ms.provenance_log.sync(fd=provenancefd)
+
     # Forward
+    @_serialized
     def open(self, path, flags):
         rval = self.parsepath(path).open(flags, path)
         return rval
 
     # Forward open file operations to repository.
 
+    @_serialized
     def release(self, path, fh):
         return self.rep.close(path)
 
+    @_serialized
     def read(self, path, size, offset):
         return self.rep.read(path, offset, size)
 
+    @_serialized
     def write(self, path, data, offset):
         rval = self.rep.write(path, offset, data)
         return rval
 
     # We don't allow any truncating.
+    @_serialized
     def truncate(self, path, len, fh=None):
         return -errno.EPERM
 
+    @_serialized
     def flush(self, path):
-        self.rep.flush()
+        self.rep.flush(path)
 
 
 # File-system startup
@@ -945,7 +1183,7 @@ def run(mattockitem="0"):
                mattockdir,
                "should exist and be owned by the mattockfs user")
         sys.exit()
-    for subdir in ["archive", "log", "mnt"]:
+    for subdir in ["archive", "log", "mnt", "notify"]:
         sd = mattockdir + "/" + subdir
         if not os.path.isdir(sd):
             try:
@@ -979,9 +1217,21 @@ def run(mattockitem="0"):
     refcount_log = mattockdir + "/log/" + mattockitem + ".refcount"
     #Merkletree log
     merkletree_log = mattockdir + "/log/" + mattockitem + ".merkletree"
+    # Wakeup pipes for workers waiting on jobs. The directory isn't listable
+    # so workers can only open the pipe they got from their worker ctl.
+    notify_dir = mattockdir + "/notify/" + mattockitem
+    if os.path.isdir(notify_dir):
+        for leftover in os.listdir(notify_dir):
+            os.unlink(notify_dir + "/" + leftover)
+    else:
+        try:
+            os.mkdir(notify_dir, 0711)
+        except:
+            notify_dir = None
     # Mountpoint.
     mp = mattockdir + "/mnt/" + mattockitem
     sys.argv.append(mp)
+    conf = get_config()
     mattockfs = MattockFS(
                   version='%prog ' + '0.3.0',
                   usage='Mattock filesystem ' + fuse.Fuse.fusage,
@@ -992,7 +1242,9 @@ def run(mattockitem="0"):
                   provenance_log=provenance_log,
                   ohash_log=ohash_log,
                   refcount_log=refcount_log,
-                  mtlog=merkletree_log)
+                  mtlog=merkletree_log,
+                  conf=conf,
+                  notify_dir=notify_dir)
     mattockfs.parse(errex=1)
     mattockfs.flags = 0
     mattockfs.multithreaded = 0
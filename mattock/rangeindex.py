@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# Copyright (c) 2015, Rob J Meijer.
+# Copyright (c) 2015, University College Dublin
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. All advertising materials mentioning features or use of this software
+#    must display the following acknowledgement:
+#    This product includes software developed by the <organization>.
+# 4. Neither the name of the <organization> nor the
+#    names of its contributors may be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY <COPYRIGHT HOLDER> ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE
+#
+import bisect
+
+
+# Sorted list of offsets (or tuples starting with an offset), kept as a list
+# of blocks so that inserting or removing an entry doesn't have to move the
+# whole list.
+class SortedOffsets:
+    def __init__(self, blocksize=256):
+        self.blocksize = blocksize
+        self.blocks = []
+        # The first offset of each block.
+        self.firsts = []
+
+    def __iter__(self):
+        for block in self.blocks:
+            for offset in block:
+                yield offset
+
+    # Index of the block that offset belongs in.
+    def _block(self, offset):
+        index = bisect.bisect_right(self.firsts, offset) - 1
+        if index < 0:
+            return 0
+        return index
+
+    def add(self, offset):
+        if not self.blocks:
+            self.blocks.append([offset])
+            self.firsts.append(offset)
+            return
+        index = self._block(offset)
+        block = self.blocks[index]
+        bisect.insort(block, offset)
+        self.firsts[index] = block[0]
+        # Split blocks that grew too big.
+        if len(block) > 2 * self.blocksize:
+            self.blocks.insert(index + 1, block[self.blocksize:])
+            self.firsts.insert(index + 1, block[self.blocksize])
+            del block[self.blocksize:]
+
+    def remove(self, offset):
+        index = self._block(offset)
+        block = self.blocks[index]
+        del block[bisect.bisect_left(block, offset)]
+        if block:
+            self.firsts[index] = block[0]
+        else:
+            del self.blocks[index]
+            del self.firsts[index]
+
+    # The highest offset not above offset, or None.
+    def floor(self, offset):
+        index = bisect.bisect_right(self.firsts, offset) - 1
+        if index < 0:
+            return None
+        block = self.blocks[index]
+        return block[bisect.bisect_right(block, offset) - 1]
+
+    # All offsets from start up to (but not including) end.
+    def irange(self, start, end):
+        rval = []
+        if not self.blocks:
+            return rval
+        index = self._block(start)
+        position = bisect.bisect_left(self.blocks[index], start)
+        while index < len(self.blocks):
+            block = self.blocks[index]
+            while position < len(block):
+                if block[position] >= end:
+                    return rval
+                rval.append(block[position])
+                position += 1
+            index += 1
+            position = 0
+        return rval
+
+
+# Index of (start, end, value) ranges for overlap lookups. Ranges are kept
+# in a separate SortedOffsets for each power of two range length, so an
+# overlap lookup only has to look back as far as the longest range in each
+# of them.
+class RangeIndex:
+    def __init__(self):
+        self.indices = dict()
+
+    def _index(self, start, end):
+        return (end - start - 1).bit_length()
+
+    def add(self, start, end, value):
+        lengthclass = self._index(start, end)
+        if lengthclass not in self.indices:
+            self.indices[lengthclass] = SortedOffsets()
+        self.indices[lengthclass].add((start, end, value))
+
+    def remove(self, start, end, value):
+        self.indices[self._index(start, end)].remove((start, end, value))
+
+    # Values of all ranges overlapping with start up to end.
+    def overlapping(self, start, end):
+        rval = []
+        for lengthclass in self.indices:
+            for (rstart, rend, value) in self.indices[lengthclass].irange(
+                                          (start - (1 << lengthclass),),
+                                          (end,)):
+                if rend > start:
+                    rval.append(value)
+        return rval
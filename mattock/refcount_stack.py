@@ -28,7 +28,11 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE
 #
+import bisect
+import heapq
 import time
+import carvpath
+import rangeindex
 
 
 # Default implementation of < for argument list.
@@ -57,6 +61,96 @@ class _CustomSortable:
         return self.ltfunction(al1=self.arglist, al2=other.arglist)
 
 
+# Get the sorted, coalesced [start, end) ranges covered by a sparse free
+# entity.
+def _entity_ranges(entity):
+    if entity.compact:
+        offsets = entity.fragments.offsets
+        sizes = entity.fragments.sizes
+        bounds = [(offsets[index], offsets[index] + sizes[index])
+                  for index in range(0, len(sizes))]
+    else:
+        bounds = [(frag.offset, frag.offset + frag.size)
+                  for frag in entity.fragments]
+    bounds.sort()
+    rval = []
+    for (start, end) in bounds:
+        if start == end:
+            continue
+        if rval and start <= rval[-1][1]:
+            if end > rval[-1][1]:
+                rval[-1][1] = end
+        else:
+            rval.append([start, end])
+    return rval
+
+
+# Split a number of lists of coalesced ranges into layers of disjoint ranges,
+# where layer n holds the parts covered by more than n of the lists.
+def _layers(rangelists):
+    deltas = dict()
+    for ranges in rangelists:
+        for (start, end) in ranges:
+            deltas[start] = deltas.get(start, 0) + 1
+            deltas[end] = deltas.get(end, 0) - 1
+    offsets = sorted(deltas.keys())
+    layers = []
+    depth = 0
+    for index in range(0, len(offsets) - 1):
+        depth += deltas[offsets[index]]
+        start = offsets[index]
+        end = offsets[index + 1]
+        for level in range(0, depth):
+            if level == len(layers):
+                layers.append([])
+            layer = layers[level]
+            if len(layer) > 0 and layer[-1][1] == start:
+                layer[-1][1] = end
+            else:
+                layer.append([start, end])
+    return layers
+
+
+# Sorted interval index for a single refcount stack level. Levels are the
+# product of merges, so their fragments are disjoint and ordered, which lets
+# us answer overlap queries for a candidate with k ranges in O(k log n)
+# instead of walking the full level with _fragapply.
+class _LevelIndex:
+    def __init__(self, ranges):
+        self.starts = []
+        self.ends = []
+        # Cumulative size of all fragments before index n.
+        self.cumulative = [0]
+        for (start, end) in ranges:
+            self.starts.append(start)
+            self.ends.append(end)
+            self.cumulative.append(self.cumulative[-1] + end - start)
+
+    # Does any of the ranges overlap with this level?
+    def overlaps(self, ranges):
+        for (start, end) in ranges:
+            index = bisect.bisect_left(self.starts, end) - 1
+            if index >= 0 and self.ends[index] > start:
+                return True
+        return False
+
+    # Number of bytes from ranges that are also part of this level.
+    def overlap_size(self, ranges):
+        rval = 0
+        for (start, end) in ranges:
+            # First level fragment ending after start, first one starting at
+            # or after end.
+            low = bisect.bisect_right(self.ends, start)
+            high = bisect.bisect_left(self.starts, end)
+            if low < high:
+                rval += self.cumulative[high] - self.cumulative[low]
+                if self.starts[low] < start:
+                    rval -= start - self.starts[low]
+                if self.ends[high - 1] > end:
+                    rval -= self.ends[high - 1] - end
+        return rval
+
+
 # The reference counting stack object.
 class CarvpathRefcountStack:
     def __init__(self, carvpathcontext, fadvise, ohashcollection,
@@ -73,6 +167,13 @@ class CarvpathRefcountStack:
         self.fragmentrefstack = []
         # At least one empty entity on the stack
         self.fragmentrefstack.append(self.context.empty())
+        # Lazily built _LevelIndex objects for the stack levels and the
+        # normalized ranges of all entities in the box.
+        self.levelindex = dict()
+        self.ranges = dict()
+        # Callables to notify of the ranges of carvpaths added to or removed
+        # from the box.
+        self.listeners = []
         self.log = open(refcount_log, "a", 0)
 
     #Bypass Refcount stack to force fadvise to underlying data chunks
@@ -107,15 +208,15 @@ class CarvpathRefcountStack:
         ent = self.context.parse(path=carvpath)
         if (
           ent.totalsize == 0 or
-          len(self.fragmentrefstack) == 0 or
-          self.fragmentrefstack[0].totalsize == 0):
+          self._levels() == 0 or
+          self.volume() == 0):
             overlapsize = 0
         else:
             # Create a copy of the entity without any sparse in it.
             nonsparse = ent.copy(stripsparse=True)
             # Calculate the overlap size between ent and refcount>0 data.
-            overlapsize = nonsparse.overlap_size(
-                            entity=self.fragmentrefstack[0])
+            overlapsize = self._level_index(0).overlap_size(
+                            _entity_ranges(nonsparse))
         return [overlapsize, ent.totalsize - overlapsize]
 
     # Serialize whole stack; for debug purposes only.
@@ -144,7 +245,7 @@ class CarvpathRefcountStack:
     # 2) An entity with all fragments already in the box before add was
     #    invoked (can be used for opportunistic hashing purposes).
     def add_carvpath(self, carvpath):
-        if carvpath in self.entityrefcount.keys():
+        if carvpath in self.entityrefcount:
             # Each CarvPath exists on the stack only once.
             self.entityrefcount[carvpath] += 1
             ent = self.content[carvpath]
@@ -158,11 +259,13 @@ class CarvpathRefcountStack:
             ent = self.context.parse(path=carvpath)
             ent.stripsparse()
             self.content[carvpath] = ent
+            self.ranges[carvpath] = _entity_ranges(ent)
             # Start refcount at one for this carvpath
             self.entityrefcount[carvpath] = 1
             # Extend the stack with the non-sparse data from this carvpath.
-            r = self._stackextend(level=0, entity=ent)
-            merged = r[0]
+            merged = self._extend(entity=ent)
+            for listener in self.listeners:
+                listener(self.ranges[carvpath])
             # Update the fadvise value for all refcount=0 -> refcount=1
             # transitions.
             for fragment in merged:
@@ -174,12 +277,52 @@ class CarvpathRefcountStack:
                 self.log.write(str(time.time()) + ":+:" + cp +"\n")
         return
 
+    # Add a batch of entities to the box. The new carvpaths are split into
+    # layers of disjoint ranges, so the stack gets extended once per layer
+    # instead of once per carvpath, and the listeners, fadvise and the
+    # refcount log see the batch as a whole.
+    def add_carvpaths(self, carvpaths):
+        rangelists = []
+        for cp in carvpaths:
+            if cp in self.entityrefcount:
+                self.entityrefcount[cp] += 1
+            else:
+                self.ohashcollection.add_carvpath(carvpath=cp)
+                ent = self.context.parse(path=cp)
+                ent.stripsparse()
+                self.content[cp] = ent
+                self.ranges[cp] = _entity_ranges(ent)
+                self.entityrefcount[cp] = 1
+                rangelists.append(self.ranges[cp])
+        layers = _layers(rangelists)
+        if len(layers) == 0:
+            return
+        merged = None
+        for layer in layers:
+            ent = self.context.empty()
+            for (start, end) in layer:
+                ent.unaryplus(other=carvpath.Fragment(offset=start,
+                                                      size=end - start))
+            # Only the bottom layer can hold refcount=0 -> refcount=1
+            # fragments, the ones above it are part of it.
+            res = self._extend(entity=ent)
+            if merged is None:
+                merged = res
+        for listener in self.listeners:
+            listener(layers[0])
+        for fragment in merged:
+            self.fadvise(offset=fragment.offset, size=fragment.size,
+                         willneed=True)
+        cp = str(merged)
+        if cp != "S0":
+            self.log.write(str(time.time()) + ":+:" + cp +"\n")
+
     # Remove an existing entity from the box. Returns two entities:
     # 1) An entity with all fragments that went from one to zero refcount
     #    (can be used for fadvise purposes).
     # 2) An entity with all fragments still remaining in the box.
     def remove_carvpath(self, carvpath):
-        if carvpath not in self.entityrefcount.keys():
+        if carvpath not in self.entityrefcount:
             raise IndexError("Carvpath " + carvpath +
                              " not found on refcount stack.")
         self.entityrefcount[carvpath] -= 1
@@ -187,13 +330,13 @@ class CarvpathRefcountStack:
             # Reference count has reached zero, remove from content/refcount
             ent = self.content.pop(carvpath)
             del self.entityrefcount[carvpath]
+            ranges = self.ranges.pop(carvpath)
             # Remove carvpath as opportunistic hasing candidate
             self.ohashcollection.remove_carvpath(carvpath=carvpath)
             # Deminish the stack with the non-sparse parts of this carvpath.
-            r = self._stackdiminish(
-                        level=len(self.fragmentrefstack)-1,
-                        entity=ent)
-            unmerged = r
+            unmerged = self._diminish(entity=ent)
+            for listener in self.listeners:
+                listener(ranges)
             if unmerged is not None:
                 # If something has gone from refcount>0 to refcount=0,
                 # then update fadvise
@@ -205,19 +348,53 @@ class CarvpathRefcountStack:
                     self.log.write(str(time.time()) + ":-:" + cp +"\n")
         return
 
+    # Return the size of the data with a refcount > 0
+    def volume(self):
+        if len(self.fragmentrefstack) == 0:
+            return 0
+        return self.fragmentrefstack[0].totalsize
+
+    # The number of refcount levels currently on the stack.
+    def _levels(self):
+        return len(self.fragmentrefstack)
+
+    # Get the (cached) interval index for a stack level.
+    def _level_index(self, level):
+        if level not in self.levelindex:
+            self.levelindex[level] = _LevelIndex(
+              _entity_ranges(self.fragmentrefstack[level]))
+        return self.levelindex[level]
+
+    # For each refcount level, the number of bytes from ranges that are
+    # part of that level, up to the highest level ranges overlap with.
+    def overlap_sizes(self, ranges):
+        rval = []
+        for level in range(0, self._levels()):
+            size = self._level_index(level).overlap_size(ranges)
+            if size == 0:
+                break
+            rval.append(size)
+        return rval
+
+    # Fraction of carvpath that overlaps with the given stack level.
+    def _density(self, carvpath, level):
+        return (float(self._level_index(level).overlap_size(
+                      self.ranges[carvpath])) /
+                float(self.content[carvpath].totalsize))
+
     def _create_sortmap_R(self, startset):
         Rmap = {}
         # Higest refcount level first down to the refcount=1 level
         # untill we find some overlap.
-        stacksize = len(self.fragmentrefstack)
+        stacksize = self._levels()
         looklevel = stacksize - 1
         somethingfound = False
         for index in range(looklevel, -1, -1):
-            hrentity = self.fragmentrefstack[index]
+            hrindex = self._level_index(index)
             # Search all overlaps at this level that are part of
             # the input set.
             for carvpath in startset:
-                if hrentity.overlaps(self.content[carvpath]):
+                if hrindex.overlaps(self.ranges[carvpath]):
                     Rmap[carvpath] = True
                     somethingfound = True
                 else:
@@ -232,18 +409,18 @@ class CarvpathRefcountStack:
 
     def _create_sortmap_r(self, startset):
         rmap = {}
-        stacksize = len(self.fragmentrefstack)
+        stacksize = self._levels()
         if stacksize > 0:
             # Only interested in refcount=1
-            hrentity = self.fragmentrefstack[0]
+            hrindex = self._level_index(0)
             for carvpath in startset:
-                if hrentity.overlaps(self.content[carvpath]):
+                if hrindex.overlaps(self.ranges[carvpath]):
                     rmap[carvpath] = True
                 else:
                     rmap[carvpath] = False
         else:
             for carvpath in startset:
-                rmap[catvpath] = False
+                rmap[carvpath] = False
         return rmap
 
     def _create_sortmap_O(self, startset):
@@ -260,18 +437,15 @@ class CarvpathRefcountStack:
 
     def _create_sortmap_D(self, startset):
         Dmap = {}
-        stacksize = len(self.fragmentrefstack)
+        stacksize = self._levels()
         looklevel = stacksize - 1
         for index in range(looklevel, -1, -1):
-            hrentity = self.fragmentrefstack[index]
+            hrindex = self._level_index(index)
             hasmatch = False
             for carvpath in startset:
-                if hrentity.overlaps(
-                  self.content[carvpath]):
+                if hrindex.overlaps(self.ranges[carvpath]):
                     # If overlaps: get+store density
-                    Dmap[carvpath] = (
-                        self.content[carvpath].density(
-                            entity=hrentity))
+                    Dmap[carvpath] = self._density(carvpath, index)
                     hasmatch = True
                 else:
                     Dmap[carvpath] = 0.0
@@ -290,30 +464,21 @@ class CarvpathRefcountStack:
         wmap = {}
         for carvpath in startset:
             accumdensity = 0
-            for index in range(
-                   0,
-                   len(self.fragmentrefstack)):
-                accumdensity += (
-                  self.content[carvpath].density(
-                    entity=self.fragmentrefstack[
-                             index]))
+            for index in range(0, self._levels()):
+                accumdensity += self._density(carvpath, index)
             wmap[carvpath] = accumdensity
         return wmap
 
     def _create_sortmap_d(self, startset):
         dmap = {}
-        stacksize = len(self.fragmentrefstack)
+        stacksize = self._levels()
         if stacksize > 0:
+            l = self._level_index(0)
             for carvpath in startset:
-                l = self.fragmentrefstack[0]
-                for carvpath in startset:
-                    if l.overlaps(
-                      self.content[carvpath]):
-                        dmap[carvpath] = (
-                            self.content[carvpath].density(
-                              entity=l))
-                    else:
-                        dmap[carvpath] = 0.0
+                if l.overlaps(self.ranges[carvpath]):
+                    dmap[carvpath] = self._density(carvpath, 0)
+                else:
+                    dmap[carvpath] = 0.0
         return dmap
 
     def _create_sortmap_H(self, startset):
@@ -323,18 +488,10 @@ class CarvpathRefcountStack:
             hmap[carvpath] = self.ohashcollection.hashing_offset(carvpath)
         return hmap
 
-    # Pick the best job after custom sorting.
-    def priority_custompick(self, params, ltfunction=_defaultlt,
-                            intransit=None, reverse=False):
-        # Set of maps to hand to use in custom sortable creation.
-        hmap = {}  # H(ashing offset)
+    # Create the sort maps for all letters of a job select policy.
+    def _sortmaps(self, params, startset):
         # List of arguments for sorting, initially empty
         arglist = []
-        # Use intransit if its given, use all jobs if not.
-        startset = intransit
-        if startset is None:
-            startset = set(self.content.keys())
-        stacksize = len(self.fragmentrefstack)
         # Process the seperate letters of the job selection policy string
         for letter in params:
             if letter == "R":
@@ -375,6 +532,16 @@ class CarvpathRefcountStack:
                                               "Invalid letter '" +
                                               letter +
                                               "' for pickspecial policy")
+        return arglist
+
+    # Pick the best job after custom sorting.
+    def priority_custompick(self, params, ltfunction=_defaultlt,
+                            intransit=None, reverse=False):
+        # Use intransit if its given, use all jobs if not.
+        startset = intransit
+        if startset is None:
+            startset = set(self.content.keys())
+        arglist = self._sortmaps(params=params, startset=startset)
         # Create a new array with CustomSortable objects.
         sortable = []
         for carvpath in startset:
@@ -391,6 +558,31 @@ class CarvpathRefcountStack:
               rval=candidate
         return rval;
 
+    # Pick up to count best jobs after custom sorting, creating the sort maps
+    # only once for the whole batch.
+    def priority_custompick_n(self, params, count, ltfunction=_defaultlt,
+                              intransit=None):
+        startset = intransit
+        if startset is None:
+            startset = set(self.content.keys())
+        arglist = self._sortmaps(params=params, startset=startset)
+        sortable = []
+        for carvpath in startset:
+            sortable.append(_CustomSortable(carvpath, ltfunction, arglist))
+        sortable.sort()
+        return sortable[:count]
+
+    # Add the fragments of entity to the stack, returns an entity with the
+    # refcount=0 -> refcount=1 fragments.
+    def _extend(self, entity):
+        return self._stackextend(level=0, entity=entity)[0]
+
+    # Remove the fragments of entity from the stack, returns an entity with
+    # the refcount=1 -> refcount=0 fragments or None.
+    def _diminish(self, entity):
+        return self._stackdiminish(level=len(self.fragmentrefstack)-1,
+                                   entity=entity)
+
     # Extend the stack with fragments from entity.
     # Recursive function starting at level zero.
     def _stackextend(self, level, entity):
@@ -400,6 +592,7 @@ class CarvpathRefcountStack:
         ent = self.fragmentrefstack[level]
         # Merge with current level.
         res = ent.merge(entity)
+        self.levelindex.pop(level, None)
         merged = res[1]
         unmerged = res[0]
         # Recursively call self for next level with unmerged frags
@@ -413,12 +606,14 @@ class CarvpathRefcountStack:
         # Start with unmerging at this level
         ent = self.fragmentrefstack[level]
         res = ent.unmerge(entity)
+        self.levelindex.pop(level, None)
         unmerged = res[1]
         remaining = res[0]
         # If unmerging resulted in depletion of this level, remove level from
         # stack.
         if len(self.fragmentrefstack[level].fragments) == 0:
             self.fragmentrefstack.pop(level)
+            self.levelindex.clear()
         # If there are additional fragments to unmerge, look at processing
         # these
         if len(remaining.fragments) > 0:
@@ -436,6 +631,397 @@ class CarvpathRefcountStack:
                 return None
 
 
+# Alternative for the refcount stack that keeps a single sorted map of
+# disjoint ranges to their reference count. Adding or removing a carvpath
+# with k ranges touches only the O(log n + k) map entries involved rather
+# than cascading merges and unmerges through every level of the stack.
+class CarvpathRefcountMap(CarvpathRefcountStack):
+    def __init__(self, carvpathcontext, fadvise, ohashcollection,
+                 refcount_log):
+        CarvpathRefcountStack.__init__(self, carvpathcontext, fadvise,
+                                       ohashcollection, refcount_log)
+        self.fragmentrefstack = None
+        # The range starting at each boundary offset runs up to the next
+        # boundary and has the refcount found in counts. The last boundary
+        # always has a refcount of zero.
+        self.bounds = rangeindex.SortedOffsets()
+        self.counts = dict()
+        # Number of bytes at each refcount, used for tracking the highest
+        # refcount.
+        self.countsize = dict()
+        self.maxcount = 0
+        self.totalsize = 0
+
+    # Get all [start, end, refcount] ranges with a refcount above zero.
+    def _ranges(self):
+        rval = []
+        previous = None
+        for offset in self.bounds:
+            if previous is not None and self.counts[previous] > 0:
+                rval.append([previous, offset, self.counts[previous]])
+            previous = offset
+        return rval
+
+    # Serialize the whole map; for debug purposes only.
+    def __str__(self):  # pragma: no cover
+        rval = ""
+        for (start, end, count) in self._ranges():
+            rval += ("   + " + str(start) + "+" + str(end - start) +
+                     " : " + str(count) + "\n")
+        for carvpath in self.content:
+            rval += ("   * " +
+                     carvpath +
+                     " : " +
+                     str(self.entityrefcount[carvpath]) +
+                     "\n")
+        return rval
+
+    def volume(self):
+        return self.totalsize
+
+    def _levels(self):
+        return self.maxcount
+
+    # Get the (cached) interval index for all data with refcount > level.
+    def _level_index(self, level):
+        if level not in self.levelindex:
+            ranges = []
+            for (start, end, count) in self._ranges():
+                if count > level:
+                    if ranges and ranges[-1][1] == start:
+                        ranges[-1][1] = end
+                    else:
+                        ranges.append([start, end])
+            self.levelindex[level] = _LevelIndex(ranges)
+        return self.levelindex[level]
+
+    def overlap_sizes(self, ranges):
+        # Bytes from ranges at each refcount.
+        countsize = dict()
+        for (start, end) in ranges:
+            count = self._count(start)
+            previous = start
+            for offset in self.bounds.irange(start + 1, end):
+                countsize[count] = countsize.get(count, 0) + offset - previous
+                count = self.counts[offset]
+                previous = offset
+            countsize[count] = countsize.get(count, 0) + end - previous
+        rval = []
+        for level in range(0, self.maxcount):
+            size = 0
+            for count in countsize:
+                if count > level:
+                    size += countsize[count]
+            if size == 0:
+                break
+            rval.append(size)
+        return rval
+
+    # Refcount of the range that offset is part of.
+    def _count(self, offset):
+        boundary = self.bounds.floor(offset)
+        if boundary is None:
+            return 0
+        return self.counts[boundary]
+
+    # Make sure there is a range boundary at offset.
+    def _split(self, offset):
+        if offset not in self.counts:
+            self.counts[offset] = self._count(offset)
+            self.bounds.add(offset)
+
+    # Add delta to the refcount of the range from start to end. Returns
+    # the sub ranges that went from zero to non zero or the other way
+    # around.
+    def _applyrange(self, start, end, delta):
+        changed = []
+        self._split(start)
+        self._split(end)
+        offsets = self.bounds.irange(start, end)
+        offsets.append(end)
+        for index in range(0, len(offsets) - 1):
+            offset = offsets[index]
+            size = offsets[index + 1] - offset
+            oldcount = self.counts[offset]
+            newcount = oldcount + delta
+            if newcount < 0:
+                raise RuntimeError("Negative refcount in CarvpathRefcountMap")
+            self.counts[offset] = newcount
+            if newcount > self.maxcount:
+                self.maxcount = newcount
+            self.countsize[oldcount] = self.countsize.get(oldcount, 0) - size
+            self.countsize[newcount] = self.countsize.get(newcount, 0) + size
+            if (oldcount == 0) != (newcount == 0):
+                self.totalsize += delta * size
+                changed.append([offset, size])
+        # Drop boundaries that no longer separate ranges with a different
+        # refcount.
+        previouscount = self._count(start - 1)
+        for offset in offsets:
+            count = self.counts[offset]
+            if count == previouscount:
+                del self.counts[offset]
+                self.bounds.remove(offset)
+            previouscount = count
+        return changed
+
+    # Add delta to the refcount of the given ranges. Returns an entity with
+    # the parts that went from zero to non zero or the other way around.
+    def _apply(self, ranges, delta):
+        changed = self.context.empty()
+        for (start, end) in ranges:
+            for (offset, size) in self._applyrange(start, end, delta):
+                changed.unaryplus(other=carvpath.Fragment(offset=offset,
+                                                          size=size))
+        if delta < 0:
+            while (self.maxcount > 0 and
+                   self.countsize.get(self.maxcount, 0) == 0):
+                self.maxcount -= 1
+        self.levelindex.clear()
+        return changed
+
+    def _extend(self, entity):
+        return self._apply(ranges=_entity_ranges(entity), delta=1)
+
+    def _diminish(self, entity):
+        return self._apply(ranges=_entity_ranges(entity), delta=-1)
+
+
+# Cached sort key ingredients for a single candidate carvpath.
+class _Candidate:
+    def __init__(self, carvpath, entity, ranges):
+        self.carvpath = carvpath
+        self.ranges = ranges
+        self.totalsize = entity.totalsize
+        # Offset of the first fragment, as used by _create_sortmap_O.
+        self.offset = None
+        if len(entity.fragments) > 0:
+            self.offset = entity.fragments[0].offset
+        # Job handles for this carvpath.
+        self.keys = set()
+        # Result of overlap_sizes, the hashing offset and the sequence number
+        # of the last update.
+        self.overlap = []
+        self.hashoffset = 0
+        self.seq = 0
+
+    # The highest refcount level the candidate overlaps with (-1 if none).
+    def level(self):
+        return len(self.overlap) - 1
+
+
+# Priority queue for picking jobs from a single anycast set according to a
+# job select policy. Rather than creating the sort maps for the whole set on
+# every pick, each policy gets heaps with lazily invalidated entries. Static
+# sort keys are calculated once per candidate. The dynamic ones are only
+# recalculated for candidates touched by a refcount or hashing offset change.
+#
+# The R and D letters depend on the highest refcount level any candidate
+# overlaps with, so for policies using them candidates are bucketed by their
+# own highest level, and each bucket has a heap for the case that it is the
+# highest bucket and one for the case it is not.
+class CandidateQueue:
+    def __init__(self, stack):
+        self.stack = stack
+        self.candidates = dict()  # Candidates by carvpath.
+        self.keys = dict()        # Carvpaths by job handle.
+        # Index of candidate ranges.
+        self.rangeindex = rangeindex.RangeIndex()
+        # Candidates that need their dynamic sort keys recalculated.
+        self.dirty = set()
+        # Number of candidates per highest refcount level.
+        self.levels = dict()
+        # Heaps by policy and by (level, highest) bucket.
+        self.heaps = dict()
+        self.seq = 0
+        stack.listeners.append(self.ranges_changed)
+        stack.ohashcollection.listeners.append(self.offset_changed)
+
+    def __len__(self):
+        return len(self.keys)
+
+    # Add a job to the queue.
+    def add(self, carvpath, key):
+        self.keys[key] = carvpath
+        if carvpath in self.candidates:
+            self.candidates[carvpath].keys.add(key)
+            return
+        candidate = _Candidate(carvpath=carvpath,
+                               entity=self.stack.content[carvpath],
+                               ranges=self.stack.ranges[carvpath])
+        candidate.keys.add(key)
+        self.candidates[carvpath] = candidate
+        for (start, end) in candidate.ranges:
+            self.rangeindex.add(start, end, carvpath)
+        self._update(candidate)
+
+    # Remove a job from the queue.
+    def remove(self, key):
+        carvpath = self.keys.pop(key)
+        candidate = self.candidates[carvpath]
+        candidate.keys.discard(key)
+        if len(candidate.keys) == 0:
+            del self.candidates[carvpath]
+            self.levels[candidate.level()] -= 1
+            self.dirty.discard(carvpath)
+            for (start, end) in candidate.ranges:
+                self.rangeindex.remove(start, end, carvpath)
+
+    # Listener for refcount changes.
+    def ranges_changed(self, ranges):
+        for (start, end) in ranges:
+            for carvpath in self.rangeindex.overlapping(start, end):
+                self.dirty.add(carvpath)
+
+    # Listener for hashing offset changes.
+    def offset_changed(self, carvpath):
+        if carvpath in self.candidates:
+            self.dirty.add(carvpath)
+
+    # Recalculate the dynamic sort keys of a candidate and queue it again.
+    def _update(self, candidate):
+        if candidate.seq != 0:
+            self.levels[candidate.level()] -= 1
+        candidate.overlap = self.stack.overlap_sizes(candidate.ranges)
+        candidate.hashoffset = self.stack.ohashcollection.hashing_offset(
+                                 candidate.carvpath)
+        self.levels[candidate.level()] = (
+          self.levels.get(candidate.level(), 0) + 1)
+        self.seq += 1
+        candidate.seq = self.seq
+        for policy in self.heaps:
+            self._push(candidate, policy)
+
+    # The sort key for a candidate, highest indicates if the candidate is
+    # part of the highest level bucket.
+    def _key(self, candidate, policy, highest):
+        key = []
+        overlap = candidate.overlap
+        totalsize = float(candidate.totalsize)
+        for letter in policy:
+            if letter == "R":
+                key.append(highest)
+            if letter == "r":
+                key.append(len(overlap) > 0)
+            if letter == "O":
+                key.append(candidate.offset)
+            if letter == "D":
+                if highest and len(overlap) > 0:
+                    key.append(float(overlap[-1]) / totalsize)
+                else:
+                    key.append(0.0)
+            if letter == "S":
+                key.append(candidate.totalsize)
+            if letter == "W":
+                accumdensity = 0
+                for size in overlap:
+                    accumdensity += float(size) / totalsize
+                key.append(accumdensity)
+            if letter == "d":
+                if len(overlap) > 0:
+                    key.append(float(overlap[0]) / totalsize)
+                else:
+                    key.append(0.0)
+            if letter == "H":
+                key.append(candidate.hashoffset)
+        return key
+
+    def _push(self, candidate, policy):
+        heaps = self.heaps[policy]
+        if "R" in policy or "D" in policy:
+            buckets = [(candidate.level(), False), (candidate.level(), True)]
+        else:
+            buckets = [None]
+        for bucket in buckets:
+            if bucket not in heaps:
+                heaps[bucket] = []
+            highest = bucket is not None and bucket[1]
+            heapq.heappush(heaps[bucket],
+                           (self._key(candidate, policy, highest),
+                            candidate.seq, candidate.carvpath))
+
+    # Is a heap entry still up to date?
+    def _valid(self, entry):
+        return (entry[2] in self.candidates and
+                self.candidates[entry[2]].seq == entry[1])
+
+    # Bring the heaps for a policy up to date and return the buckets that
+    # currently hold candidates.
+    def _buckets(self, policy):
+        for letter in policy:
+            if letter not in "RrODSWdH":
+                raise RuntimeError("Invalid letter '" + letter +
+                                   "' for pickspecial policy")
+        for carvpath in self.dirty:
+            self._update(self.candidates[carvpath])
+        self.dirty = set()
+        # Create heaps for a policy on first use, or recreate them once
+        # they get clogged with outdated entries.
+        if (policy not in self.heaps or
+           sum(map(len, self.heaps[policy].values())) >
+           4 * len(self.candidates) + 1024):
+            self.heaps[policy] = dict()
+            for carvpath in self.candidates:
+                self._push(self.candidates[carvpath], policy)
+        heaps = self.heaps[policy]
+        if "R" in policy or "D" in policy:
+            highestlevel = -1
+            for level in self.levels:
+                if self.levels[level] > 0 and level > highestlevel:
+                    highestlevel = level
+            buckets = []
+            for level in self.levels:
+                if self.levels[level] > 0:
+                    buckets.append((level, level == highestlevel and
+                                    level >= 0))
+        else:
+            buckets = [None]
+        # Drop outdated entries from the top of the heaps.
+        for bucket in buckets:
+            heap = heaps.get(bucket, [])
+            while len(heap) > 0 and not self._valid(heap[0]):
+                heapq.heappop(heap)
+        return buckets
+
+    # Get the job handle of the best job for a job select policy.
+    def best(self, policy):
+        buckets = self._buckets(policy)
+        heaps = self.heaps[policy]
+        best = None
+        for bucket in buckets:
+            heap = heaps.get(bucket, [])
+            if len(heap) > 0 and (best is None or heap[0] < best):
+                best = heap[0]
+        if best is None:
+            return None
+        return min(self.candidates[best[2]].keys)
+
+    # Get the job handles of up to count best jobs for a job select policy.
+    # The heaps are walked in order without popping, through a small heap of
+    # heap positions whose children are queued once a position is taken.
+    def best_n(self, policy, count):
+        buckets = self._buckets(policy)
+        heaps = self.heaps[policy]
+        frontier = []
+        for bucket in buckets:
+            if len(heaps.get(bucket, [])) > 0:
+                frontier.append((heaps[bucket][0], bucket, 0))
+        heapq.heapify(frontier)
+        seen = set()
+        rval = []
+        while len(frontier) > 0 and len(rval) < count:
+            (entry, bucket, index) = heapq.heappop(frontier)
+            heap = heaps[bucket]
+            for child in [2 * index + 1, 2 * index + 2]:
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], bucket, child))
+            if self._valid(entry) and entry[2] not in seen:
+                seen.add(entry[2])
+                keys = sorted(self.candidates[entry[2]].keys)
+                rval.extend(keys[:count - len(rval)])
+        return rval
+
+
 if __name__ == "__main__":  # pragma: no cover
     class FakeFadviseFunctor:
         def __call__(self, offset, size, willneed):
@@ -447,7 +1033,7 @@ if __name__ == "__main__":  # pragma: no cover
     import opportunistic_hash
     import merkletree
     fadvise = FakeFadviseFunctor()
-    mtlog = merkletree.MerkleTreeLog()
+    mtlog = merkletree.MerkleTreeLog("./test3.log")
     context = carvpath.Context({}, 160)
     col = opportunistic_hash.OpportunisticHashCollection(context, "./test.log",mtlog)
     stack = CarvpathRefcountStack(context, fadvise, col, "./test2.log")
@@ -476,3 +1062,160 @@ if __name__ == "__main__":  # pragma: no cover
     stack.remove_carvpath("182715916+1234567")
     print str(stack)
     mtlog.flush()
+    # Differential test of the refcount map against the refcount stack.
+    import random
+
+    class RecordingFadviseFunctor:
+        def __init__(self):
+            self.calls = []
+
+        def __call__(self, offset, size, willneed):
+            self.calls.append((offset, size, willneed))
+
+    def random_carvpath():
+        frags = []
+        offset = random.randint(0, 1000000)
+        for index in range(0, random.randint(1, 6)):
+            if random.random() < 0.1:
+                frags.append("S" + str(random.randint(1, 1000)))
+            size = random.randint(1, 20000)
+            frags.append(str(offset) + "+" + str(size))
+            offset += size + random.randint(0, 20000)
+        return "_".join(frags)
+    random.seed(42)
+    fadvise1 = RecordingFadviseFunctor()
+    fadvise2 = RecordingFadviseFunctor()
+    col1 = opportunistic_hash.OpportunisticHashCollection(context,
+                                                          "./test.log", mtlog)
+    col2 = opportunistic_hash.OpportunisticHashCollection(context,
+                                                          "./test.log", mtlog)
+    stack = CarvpathRefcountStack(context, fadvise1, col1, "./test2.log")
+    refmap = CarvpathRefcountMap(context, fadvise2, col2, "./test2.log")
+    active = []
+    for step in range(0, 2000):
+        if active and random.random() < 0.4:
+            cp = active.pop(random.randrange(len(active)))
+            stack.remove_carvpath(cp)
+            refmap.remove_carvpath(cp)
+        else:
+            if active and random.random() < 0.1:
+                cp = random.choice(active)
+            else:
+                cp = random_carvpath()
+            active.append(cp)
+            stack.add_carvpath(cp)
+            refmap.add_carvpath(cp)
+        if fadvise1.calls != fadvise2.calls:
+            print "FAIL: fadvise transitions differ at step", step
+            break
+        if (stack.volume() != refmap.volume() or
+           stack._levels() != refmap._levels()):
+            print "FAIL: volume or level count differs at step", step
+            break
+        if active and step % 50 == 0:
+            for policy in ["R", "r", "D", "d", "W", "S"]:
+                if (stack.priority_custompick(params=policy).arglist !=
+                   refmap.priority_custompick(params=policy).arglist):
+                    print "FAIL: policy", policy, "differs at step", step
+    print "OK: refcount map matches refcount stack"
+    # Batched adds should leave the same reference counts as single ones.
+    for stackclass in [CarvpathRefcountStack, CarvpathRefcountMap]:
+        single = stackclass(context, RecordingFadviseFunctor(), col1,
+                            "./test2.log")
+        batched = stackclass(context, RecordingFadviseFunctor(), col2,
+                             "./test2.log")
+        active = []
+        for step in range(0, 200):
+            batch = []
+            for index in range(0, random.randint(1, 10)):
+                if active and random.random() < 0.2:
+                    batch.append(random.choice(active))
+                else:
+                    batch.append(random_carvpath())
+            for cp in batch:
+                single.add_carvpath(cp)
+            batched.add_carvpaths(batch)
+            active.extend(batch)
+            for index in range(0, random.randint(0, len(active))):
+                cp = active.pop(random.randrange(len(active)))
+                single.remove_carvpath(cp)
+                batched.remove_carvpath(cp)
+            ranges = [[random.randint(0, 1000000), 0]]
+            ranges[0][1] = ranges[0][0] + random.randint(1, 200000)
+            if (single.volume() != batched.volume() or
+               single._levels() != batched._levels() or
+               single.overlap_sizes(ranges) !=
+               batched.overlap_sizes(ranges)):
+                print "FAIL: batched add differs at step", step
+                break
+    print "OK: batched adds match single adds"
+    # Check the candidate queue picks against the sort maps.
+    for stackclass in [CarvpathRefcountStack, CarvpathRefcountMap]:
+        col3 = opportunistic_hash.OpportunisticHashCollection(context,
+                                                              "./test.log",
+                                                              mtlog)
+        qstack = stackclass(context, fadvise, col3, "./test2.log")
+        queue = CandidateQueue(qstack)
+        others = []
+        jobs = dict()
+        jobcount = 0
+        failed = False
+        for step in range(0, 600):
+            choice = random.random()
+            if choice < 0.3:
+                cp = random_carvpath()
+                qstack.add_carvpath(cp)
+                jobcount += 1
+                jobs["job" + str(jobcount)] = cp
+                queue.add(carvpath=cp, key="job" + str(jobcount))
+            if choice >= 0.3 and choice < 0.5:
+                cp = random_carvpath()
+                qstack.add_carvpath(cp)
+                others.append(cp)
+            if choice >= 0.5 and choice < 0.6 and others:
+                qstack.remove_carvpath(others.pop(0))
+            if choice >= 0.6 and choice < 0.7:
+                # Read from the start of a job so hashing offsets move.
+                offset = random.randint(0, 1000000)
+                if jobs and random.random() < 0.5:
+                    offset = qstack.ranges[random.choice(jobs.values())][0][0]
+                col3.lowlevel_read_data(offset,
+                                        "x" * random.randint(1, 10000))
+            if choice >= 0.7 and jobs:
+                for policy in ["R", "r", "O", "D", "S", "W", "d", "H",
+                               "RS", "DO", "rW", "HdR"]:
+                    best = queue.best(policy)
+                    ref = qstack.priority_custompick(
+                            params=policy,
+                            intransit=set(jobs.values())).arglist
+                    got = []
+                    for somemap in qstack._sortmaps(
+                                     params=policy,
+                                     startset=set(jobs.values())):
+                        if jobs[best] in somemap:
+                            got.append(somemap[jobs[best]])
+                    if got != ref:
+                        print "FAIL: queue pick differs for", policy
+                        failed = True
+                    # A batch pick should match the start of the fully
+                    # sorted set.
+                    arglist = qstack._sortmaps(params=policy,
+                                               startset=set(jobs.values()))
+                    got = []
+                    picked = set()
+                    for key in queue.best_n(policy, 5):
+                        if jobs[key] not in picked:
+                            picked.add(jobs[key])
+                            got.append(_CustomSortable(jobs[key], _defaultlt,
+                                                       arglist).arglist)
+                    ref = qstack.priority_custompick_n(
+                            params=policy, count=len(got),
+                            intransit=set(jobs.values()))
+                    if got != [sortable.arglist for sortable in ref]:
+                        print "FAIL: queue batch differs for", policy
+                        failed = True
+                key = queue.best("S")
+                queue.remove(key)
+                qstack.remove_carvpath(jobs.pop(key))
+        if not failed:
+            print "OK: candidate queue matches sort maps"
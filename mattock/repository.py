@@ -32,6 +32,13 @@ import errno
 import copy
 import os
 import fcntl
+import time
+import threading
+import ctypes
+import ctypes.util
+import mmap
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 import carvpath
 import refcount_stack
 import opportunistic_hash
@@ -60,24 +67,863 @@ except:  # pragma: no cover
         sys.exit()
 
 
-# Functor class for fadvise on an archive fd.
+# Python 2 has no os.pread, so take pread(2) from libc. It reads straight
+# into our buffer with a single syscall and leaves the file offset alone.
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _pread = _libc.pread64
+    _pread.restype = ctypes.c_ssize_t
+except (OSError, AttributeError, TypeError):  # pragma: no cover
+    _libc = None
+    _pread = None
+
+# Linux fallocate(2) mode flags.
+_FALLOC_FL_KEEP_SIZE = 1
+_FALLOC_FL_PUNCH_HOLE = 2
+
+
+# Allocate (mode 0, growing the file if needed) or, with the proper mode
+# flags, deallocate size bytes of archive at offset. Returns False if the
+# platform or file system can't do this.
+def _fallocate(fd, mode, offset, size):
+    if _libc is None or not hasattr(_libc, "fallocate64"):  # pragma: no cover
+        return False
+    return _libc.fallocate64(ctypes.c_int(fd), ctypes.c_int(mode),
+                             ctypes.c_int64(offset),
+                             ctypes.c_int64(size)) == 0
+
+# sync_file_range(2) flags for writing out a range and waiting for it.
+_SYNC_FILE_RANGE_WAIT_BEFORE = 1
+_SYNC_FILE_RANGE_WRITE = 2
+_SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+
+# Write out the dirty pages of size bytes of archive at offset and wait for
+# them. Returns False if the platform can't do this.
+def _sync_file_range(fd, offset, size):
+    if _libc is None or not hasattr(_libc, "sync_file_range"):
+        return False  # pragma: no cover
+    return _libc.sync_file_range(ctypes.c_int(fd), ctypes.c_int64(offset),
+                                 ctypes.c_int64(size),
+                                 ctypes.c_uint(_SYNC_FILE_RANGE_WAIT_BEFORE |
+                                               _SYNC_FILE_RANGE_WRITE |
+                                               _SYNC_FILE_RANGE_WAIT_AFTER)
+                                 ) == 0
+
+
+# Size of the windows the archive gets mapped in, in mmap mode.
+_MMAP_WINDOW = 1 << 30
+
+# madvise(2) advice values as defined by Linux.
+_MADV_NORMAL = 0
+_MADV_RANDOM = 1
+_MADV_SEQUENTIAL = 2
+_MADV_WILLNEED = 3
+_MADV_DONTNEED = 4
+
+# A zero copy read-only view on part of a memory mapped window. Python 2 mmap
+# objects only do old style buffers.
+try:
+    _mapview = buffer
+except NameError:  # pragma: no cover
+    def _mapview(window, start, size):
+        return memoryview(window)[start:start + size]
+
+
+# Get the memory address of a bytearray for use with _pread_into.
+def _address(buf):
+    if _pread is None:  # pragma: no cover
+        return None
+    return ctypes.addressof((ctypes.c_char * len(buf)).from_buffer(buf))
+
+
+# Fill size bytes of bytearray buf (found at address) starting at index with
+# archive data from offset. Anything beyond the end of the archive stays
+# zero.
+def _pread_into(fd, buf, address, index, size, offset):
+    if address is not None:
+        address += index
+        while size > 0:
+            count = _pread(fd, ctypes.c_void_p(address),
+                           ctypes.c_size_t(size), ctypes.c_int64(offset))
+            if count < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:  # pragma: no cover
+                    continue
+                raise OSError(err, os.strerror(err))
+            if count == 0:
+                return
+            address += count
+            offset += count
+            size -= count
+    else:  # pragma: no cover
+        os.lseek(fd, offset, 0)
+        data = os.read(fd, size)
+        buf[index:index + len(data)] = data
+
+
+# Fill buf with archive data for a list of [index, offset, size] pieces,
+# from the mapped or striped archive if there is one.
+def _archive_fill(fd, archive, buf, address, pieces):
+    if archive is not None:
+        pieces = archive.fill(buf=buf, address=address, pieces=pieces)
+    for (index, offset, size) in pieces:
+        _pread_into(fd=fd, buf=buf, address=address, index=index, size=size,
+                    offset=offset)
+
+
+# Memory mapped read access to the archive. The archive is mapped in fixed
+# size windows, so growing it only means remapping the last window.
+class _ArchiveMap:
+    # The data lives in the main archive file, so its holes can be probed.
+    sparse = True
+
+    def __init__(self, fd, size, window=_MMAP_WINDOW):
+        self.fd = fd
+        self.window = window
+        self.windows = []
+        self.size = 0
+        self.resize(size=size)
+
+    # Map the archive up to size.
+    def resize(self, size):
+        if size <= self.size:
+            return
+        # Build a new list of windows, a flush from the durability thread
+        # may still be going over the old one.
+        windows = list(self.windows)
+        if len(windows) > 0 and self.size % self.window != 0:
+            # Replace the partial last window. The old mapping goes away
+            # once no views on it remain.
+            windows.pop()
+        while len(windows) * self.window < size:
+            start = len(windows) * self.window
+            windows.append(mmap.mmap(self.fd,
+                                     min(self.window, size - start),
+                                     mmap.MAP_SHARED,
+                                     mmap.PROT_READ | mmap.PROT_WRITE,
+                                     offset=start))
+        self.windows = windows
+        self.size = size
+
+    # Get a zero copy view of size bytes of archive data at offset. Returns
+    # None if the data isn't mapped within a single window.
+    def view(self, offset, size):
+        index = offset // self.window
+        start = offset - index * self.window
+        if (offset + size > self.size or
+                start + size > len(self.windows[index])):
+            return None
+        return _mapview(self.windows[index], start, size)
+
+    # Fill buf with archive data for a list of [index, offset, size] pieces.
+    # Returns the pieces that aren't mapped within a single window.
+    def fill(self, buf, address, pieces):
+        remaining = []
+        for piece in pieces:
+            data = self.view(offset=piece[1], size=piece[2])
+            if data is None:
+                remaining.append(piece)
+            else:
+                buf[piece[0]:piece[0] + piece[2]] = data
+        return remaining
+
+    # Data never gets written through the mapping. If a write to a page of
+    # the sparse archive fails, on a full disk for example, the whole process
+    # would get a SIGBUS rather than an error. Returning False has the caller
+    # write to the file instead; the shared mapping sees the data right away.
+    def write(self, offset, data):
+        return False
+
+    # Apply madvise advice to the mapped pages holding the given range.
+    def advise(self, offset, size, advice):
+        if _pread is None:  # pragma: no cover
+            return
+        end = min(offset + size, self.size)
+        while offset < end:
+            index = offset // self.window
+            window = self.windows[index]
+            start = offset - index * self.window
+            length = min(end - offset, len(window) - start)
+            # madvise wants a page aligned address.
+            aligned = start - start % mmap.PAGESIZE
+            address = ctypes.addressof(ctypes.c_char.from_buffer(window))
+            _libc.madvise(ctypes.c_void_p(address + aligned),
+                          ctypes.c_size_t(length + start - aligned),
+                          ctypes.c_int(advice))
+            offset += length
+
+    # Flush dirty mapped pages to the archive, either all of them or only
+    # those holding the given range.
+    def flush(self, offset=0, size=None):
+        windows = self.windows
+        mapped = sum([len(window) for window in windows])
+        if size is None:
+            size = mapped
+        end = min(offset + size, mapped)
+        while offset < end:
+            index = offset // self.window
+            window = windows[index]
+            start = offset - index * self.window
+            length = min(end - offset, len(window) - start)
+            # msync wants a page aligned offset.
+            aligned = start - start % mmap.PAGESIZE
+            window.flush(aligned, length + start - aligned)
+            offset += length
+
+
+# Default size of the stripes of a striped archive.
+_STRIPE_SIZE = 1048576
+
+# posix_fadvise advice matching our madvise advice.
+_FADVICE = {_MADV_NORMAL: POSIX_FADV_NORMAL,
+            _MADV_RANDOM: POSIX_FADV_RANDOM,
+            _MADV_SEQUENTIAL: POSIX_FADV_SEQUENTIAL,
+            _MADV_WILLNEED: POSIX_FADV_WILLNEED,
+            _MADV_DONTNEED: POSIX_FADV_DONTNEED}
+
+
+# Read the [index, offset, size] pieces of one stripe into a buffer.
+def _fill_stripe(job):
+    (fd, buf, address, pieces) = job
+    for (index, offset, size) in pieces:
+        _pread_into(fd=fd, buf=buf, address=address, index=index, size=size,
+                    offset=offset)
+
+
+# The archive offset space spread round robin over a number of backing
+# files, normally on different devices, in stripes of stripesize bytes.
+# The main archive file still holds the archive size and lock but no data.
+# Reads that span several stripes are done concurrently by a thread pool.
+class _StripedArchive:
+    # The main archive file holds no data, its holes don't mean a thing.
+    sparse = False
+
+    def __init__(self, paths, size, stripesize=_STRIPE_SIZE):
+        self.stripesize = stripesize
+        self.fds = []
+        for path in paths:
+            self.fds.append(os.open(path,
+                                    (os.O_RDWR |
+                                     os.O_LARGEFILE |
+                                     os.O_NOATIME |
+                                     os.O_CREAT)))
+        self.width = stripesize * len(self.fds)  # Bytes in a row of stripes.
+        # Reader threads get started on first use; they wouldn't survive the
+        # fork of FUSE going into the background.
+        self.pool = None
+        self.size = 0
+        self.resize(size=size)
+
+    def __del__(self):
+        if self.pool is not None:
+            self.pool.terminate()
+        for fd in self.fds:
+            os.close(fd)
+
+    # Split size bytes of archive at offset into [stripe, offset in stripe,
+    # size] pieces.
+    def _pieces(self, offset, size):
+        pieces = []
+        end = offset + size
+        while offset < end:
+            start = offset % self.stripesize
+            length = min(end - offset, self.stripesize - start)
+            pieces.append([(offset // self.stripesize) % len(self.fds),
+                           (offset // self.width) * self.stripesize + start,
+                           length])
+            offset += length
+        return pieces
+
+    # The offset in a stripe of the first byte of that stripe at or after
+    # archive offset.
+    def _local(self, offset, stripe):
+        row = offset // self.width
+        start = offset % self.width - stripe * self.stripesize
+        return row * self.stripesize + min(max(start, 0), self.stripesize)
+
+    # The [stripe, offset in stripe, size] range of each stripe that holds
+    # part of size bytes of archive at offset. Unlike _pieces this is cheap
+    # for huge ranges.
+    def _spans(self, offset, size):
+        spans = []
+        for stripe in range(0, len(self.fds)):
+            start = self._local(offset=offset, stripe=stripe)
+            end = self._local(offset=offset + size, stripe=stripe)
+            if end > start:
+                spans.append([stripe, start, end - start])
+        return spans
+
+    # Check if the stripes are big enough to hold an archive of size bytes,
+    # as they are once they have been in use for all of it.
+    def holds(self, size):
+        for stripe in range(0, len(self.fds)):
+            if (os.fstat(self.fds[stripe]).st_size <
+                    self._local(offset=size, stripe=stripe)):
+                return False
+        return True
+
+    # Grow the stripes to hold an archive of size bytes.
+    def resize(self, size):
+        if size <= self.size:
+            return
+        for stripe in range(0, len(self.fds)):
+            stripesize = self._local(offset=size, stripe=stripe)
+            if os.fstat(self.fds[stripe]).st_size < stripesize:
+                os.ftruncate(self.fds[stripe], stripesize)
+        self.size = size
+
+    # Fill buf with archive data for a list of [index, offset, size] pieces,
+    # one thread per stripe involved.
+    def fill(self, buf, address, pieces):
+        work = []
+        for fd in self.fds:
+            work.append([])
+        for (index, offset, size) in pieces:
+            for (stripe, local, length) in self._pieces(offset=offset,
+                                                        size=size):
+                work[stripe].append([index, local, length])
+                index += length
+        jobs = []
+        for stripe in range(0, len(self.fds)):
+            if len(work[stripe]) > 0:
+                jobs.append((self.fds[stripe], buf, address, work[stripe]))
+        if len(jobs) > 1:
+            if self.pool is None:
+                self.pool = ThreadPool(processes=len(self.fds))
+            self.pool.map(_fill_stripe, jobs)
+        else:
+            for job in jobs:
+                _fill_stripe(job)
+        return []
+
+    # Write data to the archive at offset.
+    def write(self, offset, data):
+        done = 0
+        for (stripe, local, length) in self._pieces(offset=offset,
+                                                    size=len(data)):
+            os.lseek(self.fds[stripe], local, 0)
+            os.write(self.fds[stripe], data[done:done + length])
+            done += length
+        return True
+
+    # Apply madvise style advice to the stripes holding the given range.
+    def advise(self, offset, size, advice):
+        for (stripe, local, length) in self._spans(offset=offset, size=size):
+            posix_fadvise(self.fds[stripe], local, length, _FADVICE[advice])
+
+    # Write out dirty pages of the stripes, either all of them or only those
+    # holding the given range.
+    def flush(self, offset=0, size=None):
+        if size is None:
+            size = self.size
+        for (stripe, local, length) in self._spans(offset=offset, size=size):
+            _sync_file_range(fd=self.fds[stripe], offset=local, size=length)
+
+
+# Durability policy for archive data on flush of an open file.
+#  strict : fsync the whole archive on every flush, read-only files included.
+#  data   : write out just the ranges written through the flushed file; an
+#           fdatasync committing block allocations follows within interval
+#           seconds from step().
+#  group  : collect the dirty ranges and write them out together with a
+#           single fdatasync once every interval seconds from step().
+class Durability:
+    def __init__(self, fd, archive=None, policy="strict", interval=1.0,
+                 fds=None):
+        if policy not in ["strict", "data", "group"]:
+            raise ValueError("Invalid durability policy: " + str(policy))
+        self.fd = fd
+        # Any other files (archive stripes) to sync along with fd.
+        self.fds = [fd]
+        if fds is not None:
+            self.fds += fds
+        self.archive = archive
+        self.policy = policy
+        self.interval = interval
+        self.pending = []  # Dirty [offset, size] ranges not yet committed.
+        self.lasttime = time.time()
+        self.syncs = 0
+
+    # Flush with the list of [offset, size] ranges dirtied through the file.
+    def flush(self, dirty):
+        if self.policy == "strict":
+            if self.archive is not None:
+                self.archive.flush()
+            self.syncs += 1
+            for fd in self.fds:
+                os.fsync(fd)
+            return 0
+        self.pending.extend(dirty)
+        if self.policy == "data":
+            self._writeout(ranges=dirty)
+        return 0
+
+    # Write out the given ranges, coalescing adjacent and overlapping ones.
+    def _writeout(self, ranges):
+        merged = []
+        for (offset, size) in sorted(ranges):
+            if len(merged) > 0 and offset <= merged[-1][0] + merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1],
+                                    offset + size - merged[-1][0])
+            else:
+                merged.append([offset, size])
+        for (offset, size) in merged:
+            if self.archive is not None:
+                self.archive.flush(offset=offset, size=size)
+            if not _sync_file_range(fd=self.fd, offset=offset, size=size):
+                # The fdatasync in commit will have to do all the work.
+                return
+
+    # Make everything flushed so far durable.
+    def commit(self):
+        self.sync(ranges=self.collect())
+
+    # Take the ranges flushed so far off the pending list, for sync(). Returns
+    # None if there is nothing to commit.
+    def collect(self):
+        self.lasttime = time.time()
+        if len(self.pending) == 0:
+            return None
+        ranges = self.pending
+        self.pending = []
+        return ranges
+
+    # Make the ranges taken by collect() durable. This only syncs files, so
+    # it can be done without holding the file system lock.
+    def sync(self, ranges):
+        if ranges is None:
+            return
+        if self.policy == "group":
+            self._writeout(ranges=ranges)
+        for fd in self.fds:
+            os.fdatasync(fd)
+        self.syncs += 1
+
+    # Called periodically; once interval seconds have passed returns the
+    # ranges to sync(), or else None.
+    def step(self):
+        if time.time() - self.lasttime >= self.interval:
+            return self.collect()
+        return None
+
+
+# lseek whence values for finding data and holes, os lacks these in python 2.
+_SEEK_DATA = 3
+_SEEK_HOLE = 4
+
+# Hole maps probe the archive in aligned windows of this many bytes, and
+# remember the data extents of up to _HOLEMAP_WINDOWS of these windows.
+_HOLEMAP_WINDOW = 1048576
+_HOLEMAP_WINDOWS = 4096
+
+
+# Check if any of size bytes of file holds data rather than holes. Without
+# SEEK_DATA support we can't tell and assume it doesn't.
+def _has_data(fd, size):
+    try:
+        return os.lseek(fd, 0, _SEEK_DATA) < size
+    except OSError:
+        # ENXIO means no data at all.
+        return False
+
+
+# Map of where the archive has data rather than holes, so holes can be read
+# as zeroes without any I/O. There is one hole map for the whole repository,
+# shared by all open files. Only the windows a read touches get probed with
+# SEEK_DATA/SEEK_HOLE, and any write or allocation anywhere in the archive
+# forgets the windows it overlaps.
+class _HoleMap:
+    def __init__(self, fd, window=_HOLEMAP_WINDOW,
+                 maxwindows=_HOLEMAP_WINDOWS):
+        self.fd = fd
+        self.window = window
+        self.maxwindows = maxwindows
+        # Window start to list of data extents, least recently used first.
+        self.extents = OrderedDict()
+        self.supported = True  # False once SEEK_DATA turns out unsupported.
+
+    # Return the [start, end] data extents within size bytes of archive at
+    # offset, or None if we don't know.
+    def data(self, offset, size):
+        if not self.supported:
+            return None
+        end = offset + size
+        result = []
+        windowstart = offset - offset % self.window
+        while windowstart < end:
+            extents = self.extents.pop(windowstart, None)
+            if extents is None:
+                extents = self._probe(start=windowstart,
+                                      end=windowstart + self.window)
+                if extents is None:
+                    self.supported = False
+                    self.extents.clear()
+                    return None
+                if len(self.extents) >= self.maxwindows:
+                    self.extents.popitem(last=False)
+            self.extents[windowstart] = extents
+            for (datastart, dataend) in extents:
+                if datastart < end and dataend > offset:
+                    start = max(datastart, offset)
+                    stop = min(dataend, end)
+                    if len(result) > 0 and result[-1][1] == start:
+                        # Data continues past the window boundary.
+                        result[-1][1] = stop
+                    else:
+                        result.append([start, stop])
+            windowstart += self.window
+        return result
+
+    # Find the data extents in a piece of archive.
+    def _probe(self, start, end):
+        extents = []
+        offset = start
+        try:
+            while offset < end:
+                datastart = os.lseek(self.fd, offset, _SEEK_DATA)
+                if datastart >= end:
+                    break
+                offset = os.lseek(self.fd, datastart, _SEEK_HOLE)
+                extents.append([datastart, min(offset, end)])
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                # No SEEK_DATA support, treat it all as data.
+                return None
+            # ENXIO means no more data after offset.
+        return extents
+
+    # Forget what we know about size bytes of archive at offset, they were
+    # written to or allocated.
+    def invalidate(self, offset, size):
+        if len(self.extents) == 0:
+            return
+        windowstart = offset - offset % self.window
+        end = offset + size
+        if (end - windowstart) // self.window > len(self.extents):
+            # Cheaper to go over what we know than over the range.
+            for start in self.extents.keys():
+                if start < end and start + self.window > offset:
+                    del self.extents[start]
+            return
+        while windowstart < end:
+            self.extents.pop(windowstart, None)
+            windowstart += self.window
+
+
+# Read times are kept for aligned archive windows of this many bytes, for up
+# to _READTIME_WINDOWS of these windows.
+_READTIME_WINDOW = 1048576
+_READTIME_WINDOWS = 4096
+
+
+# Times of the last reads from the archive, by aligned window. Data read
+# recently is likely to still be in the page cache. Windows read least
+# recently get forgotten first.
+class _ReadTimes:
+    def __init__(self, window=_READTIME_WINDOW,
+                 maxwindows=_READTIME_WINDOWS):
+        self.window = window
+        self.maxwindows = maxwindows
+        self.times = OrderedDict()  # Window start to time of last read.
+
+    # Note a read of size bytes of archive at offset.
+    def touch(self, offset, size, now):
+        windowstart = offset - offset % self.window
+        while windowstart < offset + size:
+            if self.times.pop(windowstart, None) is None and \
+                    len(self.times) >= self.maxwindows:
+                self.times.popitem(last=False)
+            self.times[windowstart] = now
+            windowstart += self.window
+
+    # Time of the last read of the window holding offset, or None.
+    def last(self, offset):
+        return self.times.get(offset - offset % self.window)
+
+
+# Size of the aligned archive blocks kept in the block cache.
+_CACHE_BLOCK = 16384
+
+
+# Bounded LRU cache of archive blocks, keyed on block aligned archive offset.
+# Blocks whose data dropped to refcount zero on the refcount stack move to a
+# cold list that gets evicted first.
+class BlockCache:
+    def __init__(self, budget, blocksize=_CACHE_BLOCK):
+        self.budget = budget  # Byte budget for all cached blocks together.
+        self.blocksize = blocksize
+        self.hot = OrderedDict()
+        self.cold = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Look up the block at offset, returns None if it isn't cached.
+    def get(self, offset):
+        if offset in self.hot:
+            lru = self.hot
+        else:
+            if offset in self.cold:
+                lru = self.cold
+            else:
+                self.misses += 1
+                return None
+        self.hits += 1
+        # Move to the most recently used end.
+        block = lru.pop(offset)
+        lru[offset] = block
+        return block
+
+    # Add a freshly read block and evict blocks to stay within budget.
+    def put(self, offset, block):
+        self.hot[offset] = block
+        while (len(self.hot) + len(self.cold)) * self.blocksize > self.budget:
+            if len(self.cold) > 0:
+                self.cold.popitem(last=False)
+            else:
+                self.hot.popitem(last=False)
+
+    # Cached blocks within a range of archive data, or only those completely
+    # inside of it.
+    def _blocks(self, offset, size, inside=False):
+        end = offset + size
+        first = offset - offset % self.blocksize
+        if inside:
+            if first < offset:
+                first += self.blocksize
+            end -= self.blocksize - 1
+        if (end - first) // self.blocksize > len(self.hot) + len(self.cold):
+            # Cheaper to look at what we have cached.
+            return [block for block in self.hot.keys() + self.cold.keys()
+                    if first <= block < end]
+        return [block for block in range(first, max(first, end),
+                                         self.blocksize)
+                if block in self.hot or block in self.cold]
+
+    # Data in the range dropped to refcount zero.
+    def demote(self, offset, size):
+        for block in self._blocks(offset=offset, size=size, inside=True):
+            if block in self.hot:
+                self.cold[block] = self.hot.pop(block)
+
+    # Data in the range went from refcount zero to one.
+    def promote(self, offset, size):
+        for block in self._blocks(offset=offset, size=size):
+            if block in self.cold:
+                self.hot[block] = self.cold.pop(block)
+
+    # Data in the range got written, drop any cached copies.
+    def invalidate(self, offset, size):
+        for block in self._blocks(offset=offset, size=size):
+            self.hot.pop(block, None)
+            self.cold.pop(block, None)
+
+    # Hits, misses, cached blocks and byte budget.
+    def status(self):
+        return [self.hits, self.misses, len(self.hot) + len(self.cold),
+                self.budget]
+
+
+# Size of the blocks staged into the tier cache.
+_TIER_BLOCK = 65536
+
+
+# Cache of hot archive data in a file on fast local storage, driven by the
+# refcount stack. Blocks of data going from refcount zero to one get staged
+# into it by a background thread, and get dropped again once they go back
+# to refcount zero or get written to. Only blocks lying completely within
+# the data that became hot get staged. When the cache file is full, new
+# blocks are not staged until others get dropped.
+class TierCache:
+    def __init__(self, path, budget, fd, archive=None, blocksize=_TIER_BLOCK):
+        # Whatever an earlier run left in the cache file is of no use.
+        self.cachefd = os.open(path,
+                               (os.O_RDWR |
+                                os.O_LARGEFILE |
+                                os.O_CREAT |
+                                os.O_TRUNC))
+        self.fd = fd  # The archive to stage from.
+        self.archive = archive
+        self.budget = budget
+        self.blocksize = blocksize
+        self.free = range(budget // blocksize - 1, -1, -1)  # Free slots.
+        self.blocks = {}  # Slot in the cache file for staged blocks.
+        self.queue = OrderedDict()  # Time each block to stage got queued.
+        self.staging = None  # The block being staged right now.
+        self.stale = False  # The block being staged got dropped meanwhile.
+        self.hits = 0
+        self.misses = 0
+        self.staged = 0
+        self.lag = 0.0  # Total seconds between queueing and staging.
+        self.closed = False
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        # The staging thread gets started on first use; it wouldn't survive
+        # the fork of FUSE going into the background.
+        self.stager = None
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        if self.stager is not None:
+            self.stager.join()
+        os.close(self.cachefd)
+
+    # Background staging of queued blocks.
+    def _stage_loop(self):
+        while True:
+            with self.lock:
+                while len(self.queue) == 0 and not self.closed:
+                    self.wakeup.wait()
+                if self.closed:
+                    return
+                (block, queued) = self.queue.popitem(last=False)
+                if len(self.free) == 0:
+                    continue
+                slot = self.free.pop()
+                self.staging = block
+                self.stale = False
+            data = bytearray(self.blocksize)
+            _archive_fill(fd=self.fd, archive=self.archive, buf=data,
+                          address=_address(data),
+                          pieces=[[0, block, self.blocksize]])
+            os.lseek(self.cachefd, slot * self.blocksize, 0)
+            os.write(self.cachefd, data)
+            with self.lock:
+                self.staging = None
+                if self.stale:
+                    self.free.append(slot)
+                else:
+                    self.blocks[block] = slot
+                    self.staged += 1
+                    self.lag += time.time() - queued
+
+    # Data in the range went from refcount zero to one, queue it for
+    # staging. No more blocks get queued than there are free slots to stage
+    # them into.
+    def stage(self, offset, size):
+        first = offset + (-offset) % self.blocksize
+        now = time.time()
+        with self.lock:
+            for block in xrange(first, offset + size - self.blocksize + 1,
+                                self.blocksize):
+                if len(self.queue) >= len(self.free):
+                    break
+                if block not in self.blocks and block not in self.queue:
+                    self.queue[block] = now
+            if self.stager is None:
+                self.stager = threading.Thread(target=self._stage_loop)
+                self.stager.daemon = True
+                self.stager.start()
+            self.wakeup.notify()
+
+    # Data in the range went back to refcount zero or got written to, drop
+    # any blocks holding part of it.
+    def drop(self, offset, size):
+        first = offset - offset % self.blocksize
+        end = offset + size
+        with self.lock:
+            if (end - first) // self.blocksize > (len(self.blocks) +
+                                                  len(self.queue)):
+                # Cheaper to go over the blocks we have than over the range.
+                blocks = [block for block in self.blocks.keys() +
+                          self.queue.keys() if first <= block < end]
+                if self.staging is not None:
+                    blocks.append(self.staging)
+            else:
+                blocks = xrange(first, end, self.blocksize)
+            for block in blocks:
+                if block in self.blocks:
+                    self.free.append(self.blocks.pop(block))
+                if block in self.queue:
+                    del self.queue[block]
+                if block == self.staging and first <= block < end:
+                    self.stale = True
+
+    # Fill buf with staged data for a list of [index, offset, size] pieces.
+    # Returns the [index, offset, size] pieces that weren't staged.
+    def fill(self, buf, address, pieces):
+        remaining = []
+        with self.lock:
+            for (index, offset, size) in pieces:
+                end = offset + size
+                while offset < end:
+                    block = offset - offset % self.blocksize
+                    length = min(end, block + self.blocksize) - offset
+                    if block in self.blocks:
+                        self.hits += 1
+                        _pread_into(fd=self.cachefd, buf=buf, address=address,
+                                    index=index, size=length,
+                                    offset=(self.blocks[block] *
+                                            self.blocksize +
+                                            offset - block))
+                    else:
+                        self.misses += 1
+                        # Extend the previous piece if this one continues it.
+                        last = [-1, -1, 0]
+                        if len(remaining) > 0:
+                            last = remaining[-1]
+                        if (last[0] + last[2] == index and
+                                last[1] + last[2] == offset):
+                            last[2] += length
+                        else:
+                            remaining.append([index, offset, length])
+                    index += length
+                    offset += length
+        return remaining
+
+    # Hits, misses, staged blocks, blocks waiting to be staged, average
+    # staging lag in milliseconds and byte budget.
+    def status(self):
+        with self.lock:
+            lag = 0
+            if self.staged > 0:
+                lag = int(1000 * self.lag / self.staged)
+            return [self.hits, self.misses, len(self.blocks),
+                    len(self.queue), lag, self.budget]
+
+
+# Functor class for fadvise on an archive fd. In mmap mode the advice goes to
+# the mapped windows too, as far as madvise has an equivalent. The block
+# cache and tier cache, if any, get told about refcount zero/one
+# transitions.
 class _FadviseFunctor:
-    def __init__(self, fd):
+    def __init__(self, fd, archive=None, cache=None, tier=None):
         self.fd = fd
+        self.archive = archive
+        self.cache = cache
+        self.tier = tier
 
     def __call__(self, offset, size, willneed):
         if willneed:
             posix_fadvise(self.fd, offset, size, POSIX_FADV_WILLNEED)
+            self._madvise(offset, size, _MADV_WILLNEED)
+            if self.cache is not None:
+                self.cache.promote(offset=offset, size=size)
+            if self.tier is not None:
+                self.tier.stage(offset=offset, size=size)
         else:
             posix_fadvise(self.fd, offset, size, POSIX_FADV_DONTNEED)
+            self._madvise(offset, size, _MADV_DONTNEED)
+            if self.cache is not None:
+                self.cache.demote(offset=offset, size=size)
+            if self.tier is not None:
+                self.tier.drop(offset=offset, size=size)
     def normal(self, offset,size):
         posix_fadvise(self.fd, offset, size, POSIX_FADV_NORMAL)
+        self._madvise(offset, size, _MADV_NORMAL)
     def random(self, offset, size):
         posix_fadvise(self.fd, offset, size, POSIX_FADV_RANDOM)
+        self._madvise(offset, size, _MADV_RANDOM)
     def sequential(self, offset, size):
         posix_fadvise(self.fd, offset, size, POSIX_FADV_SEQUENTIAL)
+        self._madvise(offset, size, _MADV_SEQUENTIAL)
     def noreuse(self, offset, size):
         posix_fadvise(self.fd, offset, size, POSIX_FADV_NOREUSE)
+    def _madvise(self, offset, size, advice):
+        if self.archive is not None:
+            self.archive.advise(offset=offset, size=size, advice=advice)
 
 
 # RAII class for keeping a file lock during sparse grow operations.
@@ -93,12 +939,24 @@ class _RaiiFLock:
 # Class representing an open file. This can either be a mutable or a carvpath
 # file.
 class _OpenFile:
-    def __init__(self, stack, cp, entity, fd, ohashcollection):
+    def __init__(self, stack, cp, entity, fd, ohashcollection, archive=None,
+                 cache=None, writebuffer=0, tier=None, holemap=None,
+                 readtimes=None):
         self.cp = cp
         self.stack = stack
         self.ohashcollection = ohashcollection
         self.entity = entity
         self.fd = fd
+        self.archive = archive  # Memory mapped archive, if any.
+        self.cache = cache  # Block cache, if any.
+        self.tier = tier  # Tier cache, if any.
+        self.dirty = []  # Archive [offset, size] ranges written, unflushed.
+        # Adjacent small writes get coalesced into a write-behind buffer of
+        # up to writebuffer bytes before they go to the archive.
+        self.writebuffer = writebuffer
+        self.pending = None  # [offset, bytearray] of buffered writes.
+        self.holemap = holemap  # Repository wide hole map, if any.
+        self.readtimes = readtimes  # Where to note the time of reads, if any.
         # Add the carvpath to the refcount stack.
         self.stack.add_carvpath(carvpath=cp)
         self.refcount = 1  # Note: This refcount is maintained by the
@@ -106,19 +964,26 @@ class _OpenFile:
         #                        stack with the same file twice.
 
     def __del__(self):
+        self.writeback()
         # Remove from refcount stack on deletion.
         self.stack.remove_carvpath(carvpath=self.cp)
 
-    def pread(self, chunk):
-        # Read the chunk from offset, os.pread would be better but does not
-        # exist in python 2.
-        if chunk.issparse():
-            return "\0" * chunk.size
-        else:
-            os.lseek(self.fd, chunk.offset, 0)
-            return os.read(self.fd, chunk.size)
-
     def pwrite(self, chunk, chunkdata):
+        if self.holemap is not None:
+            self.holemap.invalidate(offset=chunk.offset, size=len(chunkdata))
+        if (len(self.dirty) > 0 and
+                self.dirty[-1][0] + self.dirty[-1][1] == chunk.offset):
+            self.dirty[-1][1] += len(chunkdata)
+        else:
+            self.dirty.append([chunk.offset, len(chunkdata)])
+        if self.cache is not None:
+            self.cache.invalidate(offset=chunk.offset, size=len(chunkdata))
+        if self.tier is not None:
+            self.tier.drop(offset=chunk.offset, size=len(chunkdata))
+        if self.archive is not None and self.archive.write(
+                                          offset=chunk.offset,
+                                          data=chunkdata):
+            return
         # Write a chunk to the proper offset. os.pwrite would be better but
         # does not exist in python 2.
         os.lseek(self.fd, chunk.offset, 0)
@@ -126,6 +991,10 @@ class _OpenFile:
         return
 
     def read(self, offset, size):
+        # Buffered writes we are about to read must hit the archive first.
+        if (self.pending is not None and offset < self.pending[0] +
+                len(self.pending[1]) and self.pending[0] < offset + size):
+            self.writeback()
         # Create an entity object for the thing we need to read.
         readent = self.entity.subentity(
           childent=carvpath._Entity(lpmap=self.entity.longpathmap,
@@ -134,19 +1003,108 @@ class _OpenFile:
                                         offset=offset,
                                         size=size)]),
           truncate=True)
-        # Start with empty result.
-        result = b''
+        # Preallocate the result, it starts off zeroed so sparse chunks need
+        # no work at all.
+        result = bytearray(readent.totalsize)
+        address = _address(result)
+        view = memoryview(result)
+        index = 0
+        chunks = []  # [index, offset, size] of the non sparse chunks.
+        pieces = []  # [index, offset, size] of the archive data to read.
+        now = time.time()
         for chunk in readent:  # One entity chunk at a time.
-            datachunk = self.pread(chunk=chunk)  # Read chunk from  offset
-            result += datachunk  # Add chunk to result.
             if not chunk.issparse():
-                self.ohashcollection.lowlevel_read_data(
-                  offset=chunk.offset,
-                  data=datachunk)  # Do opportunistic hasing
-                  #                  if possible.
-        return result
+                chunks.append([index, chunk.offset, chunk.size])
+                if self.readtimes is not None:
+                    self.readtimes.touch(offset=chunk.offset,
+                                         size=chunk.size, now=now)
+                extents = None
+                if self.holemap is not None:
+                    extents = self.holemap.data(offset=chunk.offset,
+                                                size=chunk.size)
+                if extents is None:
+                    extents = [[chunk.offset, chunk.offset + chunk.size]]
+                for (start, end) in extents:
+                    pieces.append([index + start - chunk.offset, start,
+                                   end - start])
+            index += chunk.size
+        # Read the data parts of the chunks into their place in the result,
+        # holes stay zero. Mutables still change, keep them out of the block
+        # cache.
+        if (self.cache is not None and
+                self.cp not in self.ohashcollection.unfrozen):
+            for (index, start, size) in pieces:
+                self._cachedfill(buf=result, address=address, index=index,
+                                 offset=start, size=size)
+        else:
+            self._fill(buf=result, address=address, pieces=pieces)
+        for (index, start, size) in chunks:
+            # Holes get hashed straight from the zeroed result.
+            self.ohashcollection.lowlevel_read_data(
+              offset=start,
+              data=view[index:index + size])  # Do opportunistic hashing if
+              #                                 possible.
+        return str(result)
+
+    # Fill buf with archive data for a list of [index, offset, size] pieces,
+    # from the tier cache where possible.
+    def _fill(self, buf, address, pieces):
+        if self.tier is not None:
+            pieces = self.tier.fill(buf=buf, address=address, pieces=pieces)
+        _archive_fill(fd=self.fd, archive=self.archive, buf=buf,
+                      address=address, pieces=pieces)
+
+    # Fill size bytes of buf at index with archive data from offset by way of
+    # the block cache. Only blocks that lie completely within refcount > 0
+    # data get cached, anything else in the archive may still be written to.
+    def _cachedfill(self, buf, address, index, offset, size):
+        blocksize = self.cache.blocksize
+        end = offset + size
+        while offset < end:
+            blockstart = offset - offset % blocksize
+            size = min(end, blockstart + blocksize) - offset
+            block = self.cache.get(offset=blockstart)
+            if block is None:
+                levels = self.stack.overlap_sizes(
+                           [[blockstart, blockstart + blocksize]])
+                if len(levels) > 0 and levels[0] == blocksize:
+                    block = bytearray(blocksize)
+                    self._fill(buf=block, address=_address(block),
+                               pieces=[[0, blockstart, blocksize]])
+                    self.cache.put(offset=blockstart, block=block)
+            if block is not None:
+                start = offset - blockstart
+                buf[index:index + size] = memoryview(block)[start:start + size]
+            else:
+                self._fill(buf=buf, address=address,
+                           pieces=[[index, offset, size]])
+            index += size
+            offset += size
 
     def write(self, offset, data):
+        size = len(data)
+        if self.pending is not None:
+            pendingend = self.pending[0] + len(self.pending[1])
+            if (offset == pendingend and
+                    len(self.pending[1]) + size <= self.writebuffer):
+                # Continues the buffered extent, just append.
+                self.pending[1] += data
+                return size
+            self.writeback()
+        if size < self.writebuffer:
+            # Start a new buffered extent.
+            self.pending = [offset, bytearray(data)]
+            return size
+        return self._write(offset=offset, data=data)
+
+    # Write out any buffered writes.
+    def writeback(self):
+        if self.pending is not None:
+            (offset, data) = self.pending
+            self.pending = None
+            self._write(offset=offset, data=str(data))
+
+    def _write(self, offset, data):
         size = len(data)
         # Create an entity object for the thing we need to write.
         writeent = self.entity.subentity(
@@ -171,7 +1129,11 @@ class _OpenFile:
 
 
 class Repository:
-    def __init__(self, reppath, context, ohash_log, refcount_log, mtlog):
+    def __init__(self, reppath, context, ohash_log, refcount_log, mtlog,
+                 refcount_map=False, mmap_archive=False, block_cache=0,
+                 arena_size=0, durability="strict", commit_interval=1.0,
+                 write_buffer=0, stripes=None, stripe_size=_STRIPE_SIZE,
+                 tier_cache=None, tier_cache_size=0):
         self.context = context
         # Create a new opportunistic hash collection.
         self.col = opportunistic_hash.OpportunisticHashCollection(
@@ -193,36 +1155,155 @@ class Repository:
         posix_fadvise(self.fd, 0, cursize, POSIX_FADV_DONTNEED)
         # Create CarvPath top entity of the proper size.
         self.top = self.context.make_top(size=cursize)
+        # Optionally stripe the archive data over a list of files, or else
+        # map the archive into memory.
+        self.archive = None
+        stripefds = None
+        if stripes:
+            self.archive = _StripedArchive(paths=stripes, size=0,
+                                           stripesize=stripe_size)
+            # Striping an archive that already holds data would leave that
+            # data behind in the main archive file, unreadable.
+            if (_has_data(fd=self.fd, size=cursize) or
+                    not self.archive.holds(size=cursize)):
+                self.archive = None
+                os.close(self.fd)
+                self.fd = None
+                raise RuntimeError("Archive " + reppath +
+                                   " holds data its stripes don't have")
+            self.archive.resize(size=cursize)
+            stripefds = self.archive.fds
+        else:
+            if mmap_archive:
+                self.archive = _ArchiveMap(fd=self.fd, size=cursize)
+        # Mutables and snapshots up to arena_size get allocated from a
+        # private arena of archive space, so we don't need to lock the
+        # archive for each and every one of them.
+        self.arenasize = arena_size
+        self.arena = [cursize, cursize]  # Free part of our arena.
+        # Size of the per open file write-behind buffer, 0 to disable.
+        self.writebuffer = write_buffer
+        # What a flush does to make written data durable.
+        self.durability = Durability(fd=self.fd, archive=self.archive,
+                                     policy=durability,
+                                     interval=commit_interval,
+                                     fds=stripefds)
+        # Optional cache of hot archive blocks, with a budget in bytes.
+        self.cache = None
+        if block_cache > 0:
+            self.cache = BlockCache(budget=block_cache)
+        # Optional cache file on fast storage for data with refcount > 0.
+        self.tier = None
+        if tier_cache and tier_cache_size > 0:
+            self.tier = TierCache(path=tier_cache, budget=tier_cache_size,
+                                  fd=self.fd, archive=self.archive)
+        # Map of the holes in the archive, so reads can skip them. Striped
+        # archives keep their data elsewhere.
+        self.holemap = None
+        if self.archive is None or self.archive.sparse:
+            self.holemap = _HoleMap(fd=self.fd)
+        # When archive data was last read, to tell hot data from cold.
+        self.readtimes = _ReadTimes()
         # Create fadvise functor from fd.
-        fadvise = _FadviseFunctor(fd=self.fd)
+        fadvise = _FadviseFunctor(fd=self.fd, archive=self.archive,
+                                  cache=self.cache, tier=self.tier)
         # Create a referencecounting carvpath stack using our fadvise functor
         # and ohash collection.
-        self.stack = refcount_stack.CarvpathRefcountStack(
+        stackclass = refcount_stack.CarvpathRefcountStack
+        if refcount_map:
+            stackclass = refcount_stack.CarvpathRefcountMap
+        self.stack = stackclass(
               carvpathcontext=self.context,
               fadvise=fadvise,
               ohashcollection=self.col,
               refcount_log=refcount_log)
 
     def __del__(self):
+        if self.fd is None:
+            # We refused to start, nothing to clean up.
+            return
+        self.durability.commit()
+        self.close_arena()
+        if self.tier is not None:
+            self.tier.close()
         self.stack = None
         self.openfiles = None
+        self.archive = None
         # On destruction close the underlying file.
         os.close(self.fd)
 
     def _grow(self, chunksize):
+        if chunksize > self.arenasize:
+            return self._reserve(size=chunksize)[0]
+        if self.arena[0] + chunksize > self.arena[1]:
+            # Our arena ran out, reserve a new one.
+            extent = self._reserve(size=self.arenasize, allocate=True)
+            if extent[0] == self.arena[1]:
+                # Nobody grew the archive in between; just extend the arena.
+                self.arena[1] = extent[1]
+            else:
+                self._release(start=self.arena[0], end=self.arena[1])
+                self.arena = extent
+        offset = self.arena[0]
+        self.arena[0] += chunksize
+        return offset
+
+    # Grow the archive by size bytes and return the new [start, end) extent.
+    def _reserve(self, size, allocate=False):
         # Use a file lock to atomically allocate a new chunk of
         # (at first sparse) file data.
         l = _RaiiFLock(fd=self.fd)
         cursize = os.lseek(self.fd, 0, os.SEEK_END)
-        os.ftruncate(self.fd, cursize+chunksize)
-        self.top.grow(chunk=cursize + chunksize - self.top.size)
-        return cursize
+        # Arenas get allocated on disk up front where possible, so handing
+        # them out in pieces doesn't fragment the archive file.
+        if allocate and self.archive is not None and not self.archive.sparse:
+            # The data doesn't live in the main archive file.
+            allocate = False
+        if not (allocate and _fallocate(fd=self.fd, mode=0, offset=cursize,
+                                        size=size)):
+            os.ftruncate(self.fd, cursize + size)
+        self.top.grow(chunk=cursize + size - self.top.size)
+        if self.archive is not None:
+            self.archive.resize(size=cursize + size)
+        self._allocated(offset=cursize, size=size)
+        return [cursize, cursize + size]
+
+    # A piece of archive got (re)allocated, what we know of its holes may no
+    # longer hold.
+    def _allocated(self, offset, size):
+        if self.holemap is not None:
+            self.holemap.invalidate(offset=offset, size=size)
+
+    # Give the disk space for an unused piece of arena back to the file
+    # system. The archive keeps its size, the range reads as zeroes.
+    def _release(self, start, end):
+        if start < end:
+            _fallocate(fd=self.fd,
+                       mode=_FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_KEEP_SIZE,
+                       offset=start, size=end - start)
+            self._allocated(offset=start, size=end - start)
+
+    # Hand back the disk space of the unused tail of our arena on shutdown.
+    # The archive never gets truncated, other instances may have it mapped
+    # up to its current size and would fault on pages beyond the new end.
+    def close_arena(self):
+        (start, end) = self.arena
+        if start < end:
+            self._release(start=start, end=end)
+            self.arena = [start, start]
 
     def snapshot(self,data):
         chunksize = len(data)
         offset = self._grow(chunksize=chunksize)
-        os.lseek(self.fd, offset, 0)
-        os.write(self.fd, data)
+        self._allocated(offset=offset, size=chunksize)
+        if self.cache is not None:
+            self.cache.invalidate(offset=offset, size=chunksize)
+        if self.tier is not None:
+            self.tier.drop(offset=offset, size=chunksize)
+        if self.archive is None or not self.archive.write(offset=offset,
+                                                          data=data):
+            os.lseek(self.fd, offset, 0)
+            os.write(self.fd, data)
         cp = str(carvpath._Entity(lpmap=self.context.longpathmap,
                                   maxfstoken=self.context.maxfstoken,
                                   fragments=[
@@ -235,13 +1316,19 @@ class Repository:
     def multi_sync(self):
         cursize = os.lseek(self.fd, 0, os.SEEK_END)
         grown = cursize - self.top.size
+        if grown > 0:
+            # Some other instance grew the archive and may have written to it.
+            self._allocated(offset=self.top.size, size=grown)
         self.top.grow(chunk=grown)
+        if self.archive is not None:
+            self.archive.resize(size=cursize)
         return grown
 
     # Allocate a new piece of mutable data and return CarvPath
     def newmutable(self, chunksize):
         # Grow the underlying archive by chunksize
         chunkoffset = self._grow(chunksize=chunksize)
+        self._allocated(offset=chunkoffset, size=chunksize)
         # Get the (currently still secret) carvpath of the unfrozen allocated
         # chunk.
         cp = str(carvpath._Entity(lpmap=self.context.longpathmap,
@@ -249,13 +1336,13 @@ class Repository:
                                   fragments=[
                                      carvpath.Fragment(offset=chunkoffset,
                                                        size=chunksize)]))
+        # Keep background hashing away from it until it is frozen.
+        self.col.mutable(carvpath=cp)
         return cp
 
     # Return the size of the part of the repository with a refcount > 0
     def volume(self):
-        if len(self.stack.fragmentrefstack) == 0:
-            return 0
-        return self.stack.fragmentrefstack[0].totalsize
+        return self.stack.volume()
 
     # Check if a given carvpath is valid and possible within the repository
     # size.
@@ -275,6 +1362,12 @@ class Repository:
             # Invalid format.
             return False
 
+    # Write out buffered writes for any open file of the given carvpath.
+    def writeback(self, carvpath):
+        for openfile in self.openfiles.values():
+            if openfile.cp == carvpath:
+                openfile.writeback()
+
     # Flatten a two level carvpath.
     def flatten(self, basecp, subcp):
         try:
@@ -283,17 +1376,15 @@ class Repository:
         except:
             return None
 
-    # Get the volume of the combined job carvpaths in a named anycast set.
-    def anycast_set_volume(self, anycast):
-        volume = 0
-        for jobid in anycast:
-            cp = anycast[jobid].carvpath
-            volume += self.context.parse(
-                  path=anycast[jobid].carvpath).totalsize
-        return volume
+    # Create a priority queue for picking jobs from an anycast set.
+    def anycast_queue(self):
+        return refcount_stack.CandidateQueue(stack=self.stack)
 
     # Get the most suitable entity from a given set according to given policy
-    def anycast_best(self, anycast, sort_policy):
+    def anycast_best(self, anycast, sort_policy, queue=None):
+        # Use the priority queue of the anycast set if there is one.
+        if queue is not None:
+            return queue.best(policy=sort_policy)
         if len(anycast) > 0:
             # Convert anycast set to a carvpath indexed map.
             cp2key = {}
@@ -310,6 +1401,28 @@ class Repository:
             return cp2key[bestcp]
         return None
 
+    # Get up to count of the most suitable entities from a given set according
+    # to given policy, ranking the set only once.
+    def anycast_best_n(self, anycast, sort_policy, count, queue=None):
+        if queue is not None:
+            return queue.best_n(policy=sort_policy, count=count)
+        if len(anycast) > 0:
+            # Map carvpaths to the job handles of the set.
+            cp2keys = {}
+            for anycastkey in anycast.keys():
+                cp = anycast[anycastkey].carvpath
+                if cp not in cp2keys:
+                    cp2keys[cp] = []
+                cp2keys[cp].append(anycastkey)
+            rval = []
+            for sortable in self.stack.priority_custompick_n(
+                              params=sort_policy,
+                              count=count,
+                              intransit=cp2keys.keys()):
+                rval.extend(sorted(cp2keys[sortable.carvpath]))
+            return rval[:count]
+        return []
+
     # Get fadvise info on the underlying repository file.
     def getTopThrottleInfo(self):
         totalsize = self.top.size
@@ -335,7 +1448,7 @@ class Repository:
                 # Fetch set volume if policy demands it.
                 volume = 0
                 if fetchvolume:
-                    volume = self.anycast_set_volume(anycast=anycast)
+                    volume = actorsstate.actors[actor].volume
                 val = 0
                 # Get the value to find the best actor with depending on
                 # policy letter.
@@ -389,7 +1502,13 @@ class Repository:
                                              cp=carvpath,
                                              entity=ent,
                                              fd=self.fd,
-                                             ohashcollection=col)
+                                             ohashcollection=col,
+                                             archive=self.archive,
+                                             cache=self.cache,
+                                             writebuffer=self.writebuffer,
+                                             tier=self.tier,
+                                             holemap=self.holemap,
+                                             readtimes=self.readtimes)
         return 0
 
     # Read data from an open file
@@ -404,8 +1523,14 @@ class Repository:
             return self.openfiles[path].write(offset=offset, data=data)
         return -errno.EIO
 
-    def flush(self):
-        return os.fsync(self.fd)
+    # Flush an open file according to the durability policy.
+    def flush(self, path=None):
+        dirty = []
+        if path in self.openfiles:
+            self.openfiles[path].writeback()
+            dirty = self.openfiles[path].dirty
+            self.openfiles[path].dirty = []
+        return self.durability.flush(dirty=dirty)
 
     # Close a file.
     def close(self, path):
@@ -413,10 +1538,144 @@ class Repository:
         self.openfiles[path].refcount -= 1
         # Only delete open file once refcount reaches zero.
         if self.openfiles[path].refcount < 1:
+            self.openfiles[path].writeback()
             del self.openfiles[path]
         return 0
 
 
+# Idle-time completion of stalled opportunistic hashes. Hashing only moves on
+# when someone reads exactly at the hashing offset, so many carvpaths leave
+# the tool chain with an incomplete hash. Only candidates whose data at the
+# hashing offset was read recently by someone else get completed, as that
+# data is likely still in the page cache. Reading the missing tail of such a
+# candidate now saves a cold re-read later on. Reads of our own don't count
+# as recent, so we don't go on into cold data. Reads are limited by a budget
+# in bytes per second.
+class HashCompleter:
+    def __init__(self, rep, budget=0, stalltime=5.0, hottime=30.0,
+                 chunksize=1048576):
+        self.rep = rep
+        self.budget = budget
+        # Seconds a hashing offset must stay put before we consider it
+        # stalled.
+        self.stalltime = stalltime
+        # Seconds since the last read for data to still count as hot.
+        self.hottime = hottime
+        # Maximum size of a single read.
+        self.chunksize = chunksize
+        self.tokens = 0
+        self.lasttime = time.time()
+        # Last seen hashing offset for each candidate and when it was first
+        # seen.
+        self.progress = dict()
+        # Candidates that didn't move on when we read at their offset.
+        self.skip = set()
+        self.completed = 0
+        self.bytesread = 0
+
+    # Pick the stalled candidate with the smallest missing tail.
+    def _candidate(self, now):
+        col = self.rep.col
+        for carvpath in self.progress.keys():
+            if carvpath not in col.ohash:
+                del self.progress[carvpath]
+                self.skip.discard(carvpath)
+        best = None
+        bestsize = 0
+        for carvpath in col.ohash:
+            ohent = col.ohash[carvpath]
+            if (ohent.hashing_isdone() or carvpath in col.unfrozen or
+                    carvpath in self.skip):
+                continue
+            offset = ohent.hashing_offset()
+            if (carvpath not in self.progress or
+                    self.progress[carvpath][0] != offset):
+                self.progress[carvpath] = [offset, now]
+                continue
+            if now - self.progress[carvpath][1] < self.stalltime:
+                continue
+            if not self._hot(ohent=ohent, now=now):
+                continue
+            tailsize = ohent.ohash.fullsize - offset
+            if best is None or tailsize < bestsize:
+                best = carvpath
+                bestsize = tailsize
+        return best
+
+    # Check if the archive data at the hashing offset of a candidate, or
+    # right before it, was read recently.
+    def _hot(self, ohent, now):
+        fragments = ohent.ent.fragments
+        offset = ohent.hashing_offset()
+        (index, childoffset) = ohent.ent.fragment_at(offset=offset)
+        while index < len(fragments) and fragments[index].issparse():
+            childoffset += fragments[index].size
+            index += 1
+        if index == len(fragments):
+            # Nothing but sparse data left to hash, no I/O needed.
+            return True
+        start = fragments[index].offset + max(offset - childoffset, 0)
+        for archiveoffset in (start, start - 1):
+            last = self.rep.readtimes.last(offset=archiveoffset)
+            if last is not None and now - last < self.hottime:
+                return True
+        return False
+
+    # Do at most one budgeted read for the best stalled candidate. Returns
+    # the number of bytes read.
+    def step(self):
+        now = time.time()
+        self.tokens = min(self.budget,
+                          self.tokens + self.budget * (now - self.lasttime))
+        self.lasttime = now
+        if self.budget <= 0:
+            return 0
+        carvpath = self._candidate(now)
+        if carvpath is None:
+            return 0
+        col = self.rep.col
+        offset = col.hashing_offset(carvpath=carvpath)
+        size = min(int(self.tokens), self.chunksize,
+                   col.ohash[carvpath].ohash.fullsize - offset)
+        # Wait for more budget unless we can finish the hash.
+        if size < min(self.chunksize, self.budget) and \
+                size < col.ohash[carvpath].ohash.fullsize - offset:
+            return 0
+        openfile = _OpenFile(stack=self.rep.stack,
+                             cp=carvpath,
+                             entity=self.rep.context.parse(path=carvpath),
+                             fd=self.rep.fd,
+                             ohashcollection=col,
+                             archive=self.rep.archive,
+                             cache=self.rep.cache,
+                             tier=self.rep.tier,
+                             holemap=self.rep.holemap)
+        data = openfile.read(offset=offset, size=size)
+        openfile = None
+        self.tokens -= len(data)
+        self.bytesread += len(data)
+        if col.hashing_isdone(carvpath=carvpath):
+            self.completed += 1
+        else:
+            newoffset = col.hashing_offset(carvpath=carvpath)
+            if newoffset == offset:
+                # Hashing didn't move on, don't keep trying.
+                self.skip.add(carvpath)
+            self.progress[carvpath] = [newoffset, now - self.stalltime]
+        return len(data)
+
+    # Candidates currently waiting for completion, completed hashes and
+    # bytes read so far.
+    def status(self):
+        col = self.rep.col
+        pending = 0
+        for carvpath in col.ohash:
+            if not (col.ohash[carvpath].hashing_isdone() or
+                    carvpath in col.unfrozen):
+                pending += 1
+        return [pending, self.completed, self.bytesread]
+
+
 if __name__ == "__main__":  # pragma: no cover
     import carvpath
     import opportunistic_hash